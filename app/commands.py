@@ -3,9 +3,10 @@ import click
 import time
 import re
 import pandas as pd
+import numpy as np
 from flask.cli import with_appcontext
 from sqlalchemy import or_, cast, JSON, Text
-from .models import db, BeritaBps, User, DocumentChunk
+from .models import db, BeritaBps, User, DocumentChunk, FeedbackStatsCounter
 from werkzeug.security import generate_password_hash
 from .services import EmbeddingService
 from .vector_db import get_collections
@@ -231,34 +232,42 @@ def register_commands(app):
         click.echo('Starting to generate embeddings for Berita BPS...')
 
         embedding_service = EmbeddingService()
-        
-        # Query di dalam konteks aplikasi
-        with app.app_context():
-            items_to_process = BeritaBps.query.filter(BeritaBps.embedding == None).yield_per(chunk_size)
 
-            count = 0
-            for item in items_to_process:
-                tags_string = ', '.join(item.tags) if isinstance(item.tags, list) else ''
-                text_to_embed = f"Judul: {item.judul_berita}\nRingkasan: {item.ringkasan}\nTags: {tags_string}"
+        def process_batch(items):
+            """Embed satu batch berita lewat satu request batchEmbedContents, lalu commit."""
+            texts = [item.embedding_text() for item in items]
 
-                embedding = embedding_service.generate(text_to_embed)
+            embeddings = embedding_service.generate_batch(texts)
 
+            generated = 0
+            for item, embedding in zip(items, embeddings):
                 if embedding:
                     item.embedding = embedding
-                    db.session.add(item)
                     click.echo(f"Generated embedding for Berita ID: {item.id}")
-                    count += 1
+                    generated += 1
                 else:
                     click.echo(f"Failed to generate embedding for Berita ID: {item.id}", err=True)
 
-                # Commit per chunk untuk efisiensi
-                if count % chunk_size == 0:
-                    db.session.commit()
-                    click.echo(f"--- Committed chunk of {chunk_size} items ---")
-                
-                time.sleep(1)
-
             db.session.commit()
+            click.echo(f"--- Committed chunk of {len(items)} items ---")
+            return generated
+        
+        # Query di dalam konteks aplikasi
+        with app.app_context():
+            items_to_process = BeritaBps.query.filter(BeritaBps.embedding == None).yield_per(chunk_size)
+
+            count = 0
+            batch = []
+            for item in items_to_process:
+                batch.append(item)
+                if len(batch) >= chunk_size:
+                    count += process_batch(batch)
+                    batch = []
+                    time.sleep(1)
+
+            if batch:
+                count += process_batch(batch)
+
             click.echo(f'Embedding generation complete. Processed {count} items.')
 
     @app.cli.command("db:seed")
@@ -359,7 +368,7 @@ def register_commands(app):
         if all_berita:
             berita_collection.upsert(
                 ids=[str(item.id) for item in all_berita],
-                embeddings=[item.embedding.tolist() for item in all_berita],
+                embeddings=[np.asarray(item.embedding, dtype=np.float32) for item in all_berita],
                 metadatas=[
                     {"judul": item.judul_berita, "tanggal_rilis": str(item.tanggal_rilis)}
                     for item in all_berita
@@ -382,7 +391,7 @@ def register_commands(app):
 
             document_collection.upsert(
                 ids=[str(item.id) for item in batch_chunks],
-                embeddings=[item.embedding.tolist() for item in batch_chunks],
+                embeddings=[np.asarray(item.embedding, dtype=np.float32) for item in batch_chunks],
                 metadatas=[
                     {"document_id": str(item.document_id), "page_number": item.page_number}
                     for item in batch_chunks
@@ -442,4 +451,17 @@ def register_commands(app):
             print("Database config created")
         else:
             print("Migration failed")
-            
\ No newline at end of file
+
+    @app.cli.command("stats:rebuild-feedback")
+    @with_appcontext
+    def rebuild_feedback_stats():
+        """
+        Menghitung ulang tabel counter statistik feedback dari data yang ada.
+        Jalankan sekali setelah deploy tabel 'feedback_stats', atau kapan pun counter perlu dikoreksi.
+        """
+        counter = FeedbackStatsCounter.rebuild()
+        click.secho("✅ Counter statistik feedback berhasil dihitung ulang.", fg='green')
+        click.echo(f"   - Total feedback: {counter.total}")
+        click.echo(f"   - Feedback positif: {counter.positive}")
+        click.echo(f"   - Total prompt: {counter.total_prompts}")
+        click.echo(f"   - Prompt dengan feedback: {counter.prompts_with_feedback}")
@@ -1,9 +1,22 @@
 import re
+import orjson
+from flask import Response
 from app.models import BeritaBps, DocumentChunk, PromptLog, DocumentFeedbackScore
 import nltk
 from datetime import datetime
 from nltk.corpus import stopwords
 
+def ojsonify(obj, status: int = 200) -> Response:
+    """
+    Pengganti jsonify untuk payload besar: serialisasi dengan orjson
+    (langsung menghasilkan bytes, datetime didukung secara native).
+    """
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+def sse_event(obj) -> str:
+    """Satu event Server-Sent Events ('data: <json>'), diserialisasi dengan orjson."""
+    return f"data: {orjson.dumps(obj).decode()}\n\n"
+
 BPS_ACRONYM_DICTIONARY = {
     'ntp': 'nilai tukar petani',
     'ipm': 'indeks pembangunan manusia',
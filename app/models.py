@@ -2,6 +2,7 @@ from flask_sqlalchemy import SQLAlchemy
 from pgvector.sqlalchemy import Vector
 from sqlalchemy.orm import relationship
 from sqlalchemy import JSON, Enum, event, inspect, ForeignKey, Uuid, DateTime, Integer, Text, String
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta  
 import uuid
@@ -36,6 +37,12 @@ class GeminiApiKeyConfig(db.Model):
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc), onupdate=lambda: datetime.now(pytz.utc))
 
+    __table_args__ = (
+        # Partial index untuk scan reset quota (reset_key.py): hanya baris yang sedang quota_exceeded
+        db.Index('idx_gemini_key_quota', quota_exceeded_at,
+                 postgresql_where=db.text('quota_exceeded = true')),
+    )
+
     def get_quota_reset_time(self):
         """Menghitung waktu reset quota (asumsi reset setiap 24 jam)"""
         if not self.quota_exceeded_at:
@@ -171,15 +178,16 @@ class BeritaBps(db.Model):
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc), onupdate=lambda: datetime.now(pytz.utc))
 
+    def embedding_text(self) -> str:
+        """Teks yang di-embed: gabungan judul, ringkasan, dan tags agar embedding lebih kaya."""
+        tags_string = ', '.join(self.tags) if isinstance(self.tags, list) else ''
+        return f"Judul: {self.judul_berita}\nRingkasan: {self.ringkasan}\nTags: {tags_string}"
+
 def generate_embedding_listener(mapper, connection, target):
     """
     Fungsi ini akan dijalankan sebelum insert atau update pada model BeritaBps.
     'target' adalah instance dari BeritaBps yang akan disimpan.
     """
-    from app.services import EmbeddingService
-    embedding_service = EmbeddingService()
-
-
     # Cek apakah ada perubahan pada judul atau ringkasan (hanya untuk event 'update')
     # Ini penting agar kita tidak membuat embedding baru jika hanya kolom lain yang diubah.
     state = inspect(target)
@@ -187,10 +195,11 @@ def generate_embedding_listener(mapper, connection, target):
         return # Tidak ada perubahan pada kolom relevan, jadi lewati
 
     # Gabungkan teks dari judul, ringkasan, dan tags untuk membuat embedding yang kaya
-    tags_string = ', '.join(target.tags) if isinstance(target.tags, list) else ''
-    text_to_embed = f"Judul: {target.judul_berita}\nRingkasan: {target.ringkasan}\nTags: {tags_string}"
+    text_to_embed = target.embedding_text()
 
     # Generate embedding baru
+    from app.services import EmbeddingService
+    embedding_service = EmbeddingService()
     new_embedding = embedding_service.generate(text_to_embed)
 
     # Tetapkan embedding baru ke instance model
@@ -226,17 +235,96 @@ class PromptLog(db.Model):
     # Relasi ke feedback
     feedbacks = db.relationship('Feedback', backref='prompt_log', lazy=True, cascade="all, delete-orphan")
 
+    # Index komposit untuk lookup "log terbaru per sesi" (filter session_id, ORDER BY id DESC)
+    __table_args__ = (
+        db.Index('ix_promptlog_session_id_id', session_id, id.desc()),
+    )
+
 class Feedback(db.Model):
     __tablename__ = 'feedback'
 
     id = db.Column(db.Integer, primary_key=True)
-    prompt_log_id = db.Column(db.Integer, db.ForeignKey('prompt_logs.id'), nullable=False)
+    prompt_log_id = db.Column(db.Integer, db.ForeignKey('prompt_logs.id'), nullable=False, index=True)
     type = db.Column(Enum('positive', 'negative', name='feedback_type_enum'), nullable=False)
     comment = db.Column(db.Text, nullable=True)
     session_id = db.Column(db.String(255), nullable=True, index=True)
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc), onupdate=lambda: datetime.now(pytz.utc))
 
+    # Index untuk paginasi feedback terbaru (ORDER BY created_at DESC, id DESC)
+    __table_args__ = (
+        db.Index('ix_feedback_created_at_id', created_at.desc(), id.desc()),
+    )
+
+class FeedbackStatsCounter(db.Model):
+    """
+    Counter statistik feedback yang di-maintain secara atomik (satu baris, id=1).
+    GET /feedback cukup membaca baris ini tanpa menjalankan COUNT di setiap request.
+    """
+    __tablename__ = 'feedback_stats'
+
+    SINGLETON_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    positive = db.Column(db.Integer, nullable=False, default=0)
+    total_prompts = db.Column(db.Integer, nullable=False, default=0)
+    prompts_with_feedback = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc), onupdate=lambda: datetime.now(pytz.utc))
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Menghitung ulang semua counter dari tabel sumber (bootstrap / koreksi drift).
+        Baris dibuat dengan INSERT ... ON CONFLICT DO NOTHING lalu dihitung ulang dengan satu
+        UPDATE, sehingga aman dijalankan bersamaan (tidak ada IntegrityError dari dua insert).
+        """
+        db.session.execute(
+            pg_insert(cls).values(id=cls.SINGLETON_ID, total=0, positive=0,
+                                  total_prompts=0, prompts_with_feedback=0)
+            .on_conflict_do_nothing(index_elements=['id'])
+        )
+        db.session.execute(
+            db.update(cls).where(cls.id == cls.SINGLETON_ID).values(
+                total=db.select(db.func.count(Feedback.id)).scalar_subquery(),
+                positive=db.select(db.func.count(Feedback.id)).where(Feedback.type == 'positive').scalar_subquery(),
+                total_prompts=db.select(db.func.count(PromptLog.id)).scalar_subquery(),
+                prompts_with_feedback=db.select(db.func.count(db.distinct(Feedback.prompt_log_id))).scalar_subquery(),
+                updated_at=datetime.now(pytz.utc)
+            )
+        )
+        db.session.commit()
+        return db.session.get(cls, cls.SINGLETON_ID, populate_existing=True)
+
+    @classmethod
+    def get_or_rebuild(cls):
+        """Ambil baris counter; jika belum ada, bootstrap dari data yang sudah ada."""
+        return db.session.get(cls, cls.SINGLETON_ID) or cls.rebuild()
+
+    @classmethod
+    def record_feedback(cls, is_positive: bool, is_first_for_prompt: bool):
+        """
+        Tambah counter untuk satu feedback baru dalam transaksi yang sedang berjalan
+        (tanpa commit, ikut di-commit bersama insert Feedback).
+        """
+        db.session.execute(
+            db.update(cls).where(cls.id == cls.SINGLETON_ID).values(
+                total=cls.total + 1,
+                positive=cls.positive + (1 if is_positive else 0),
+                prompts_with_feedback=cls.prompts_with_feedback + (1 if is_first_for_prompt else 0)
+            )
+        )
+
+def increment_prompt_counter_listener(mapper, connection, target):
+    """Dijalankan setelah insert PromptLog: tambah total_prompts pada transaksi yang sama."""
+    connection.execute(
+        FeedbackStatsCounter.__table__.update()
+        .where(FeedbackStatsCounter.__table__.c.id == FeedbackStatsCounter.SINGLETON_ID)
+        .values(total_prompts=FeedbackStatsCounter.__table__.c.total_prompts + 1)
+    )
+
+event.listen(PromptLog, 'after_insert', increment_prompt_counter_listener)
+
 class PdfDocument(db.Model):
     """
     Menyimpan metadata untuk setiap file PDF yang diunggah atau diproses.
@@ -253,7 +341,10 @@ class PdfDocument(db.Model):
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.utc), onupdate=lambda: datetime.now(pytz.utc))
 
-    chunks = relationship('DocumentChunk', back_populates='document', lazy='dynamic', cascade="all, delete-orphan")
+    # passive_deletes: hapus dokumen tidak memuat semua chunk (beserta embedding-nya) ke memori;
+    # chunk dihapus oleh ON DELETE CASCADE / bulk delete (lihat routes.document.delete_document)
+    chunks = relationship('DocumentChunk', back_populates='document', lazy='dynamic',
+                          cascade="all, delete-orphan", passive_deletes=True)
 
     def __repr__(self):
         return f'<PdfDocument {self.filename}>'
@@ -266,7 +357,8 @@ class DocumentChunk(db.Model):
     __tablename__ = 'document_chunks'
 
     id = db.Column(Uuid, primary_key=True, default=uuid.uuid4)
-    document_id = db.Column(Uuid, ForeignKey('pdf_documents.id'), nullable=False, index=True)
+    # Diindeks lewat ix_document_chunks_document_id_page (document_id di kolom pertama)
+    document_id = db.Column(Uuid, ForeignKey('pdf_documents.id', ondelete='CASCADE'), nullable=False)
     
     page_number = db.Column(Integer, nullable=False)
     chunk_content = db.Column(Text, nullable=False)
@@ -278,6 +370,11 @@ class DocumentChunk(db.Model):
 
     document = relationship('PdfDocument', back_populates='chunks')
 
+    __table_args__ = (
+        # Filter per dokumen + MAX(page_number) untuk resume cukup dari index
+        db.Index('ix_document_chunks_document_id_page', document_id, page_number),
+    )
+
     def __repr__(self):
         return f'<DocumentChunk Page {self.page_number} of Doc ID {self.document_id}>'
 
@@ -288,19 +385,22 @@ def generate_chunk_embedding_listener(mapper, connection, target):
     Dijalankan sebelum insert atau update pada DocumentChunk.
     Membuat embedding dari chunk_content.
     """
-    from app.services import EmbeddingService
-    embedding_service = EmbeddingService()
-
     state = inspect(target)
     
     # Hanya generate embedding jika 'chunk_content' berubah atau saat data baru dibuat
     if state.modified and not state.attrs.chunk_content.history.has_changes():
         return
 
+    # Embedding sudah diisi lewat batch (lihat _embed_pending_chunks), tidak perlu request ulang
+    if target.embedding is not None and state.attrs.embedding.history.has_changes():
+        return
+
     # Teks yang akan di-embed
     text_to_embed = target.chunk_content
 
     if text_to_embed:
+        from app.services import EmbeddingService
+        embedding_service = EmbeddingService()
         new_embedding = embedding_service.generate(text_to_embed)
         if new_embedding is not None:
             target.embedding = new_embedding
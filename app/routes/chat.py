@@ -12,7 +12,7 @@ from app.helpers import (
     extract_years, detect_intent, extract_keywords, build_context,
     build_final_prompt, expand_query_with_synonyms, BPS_ACRONYM_DICTIONARY,
     format_conversation_history,
-    rerank_with_dss, expand_query_with_years
+    rerank_with_dss, expand_query_with_years, sse_event
 )
 from sqlalchemy.orm import aliased
 from app import cache
@@ -24,7 +24,7 @@ gemini_service = GeminiService()
 
 def send_thinking_status(status, detail=""):
     """Helper untuk mengirim status thinking ke client"""
-    return f"data: {json.dumps({'thinking': True, 'status': status, 'detail': detail})}\n\n"
+    return sse_event({'thinking': True, 'status': status, 'detail': detail})
 
 
 def get_combined_relevant_results(user_prompt: str, requested_years: list = [], specific_document: str = None,
@@ -237,14 +237,13 @@ def stream():
         def generate_from_cache():
             # Simulasi status "thinking" sejenak (agar UX konsisten)
             yield send_thinking_status("cached", "Menemukan jawaban di memori (Cache Hit)...")
-            yield f"data: {json.dumps({'thinking': False})}\n\n"
+            yield sse_event({'thinking': False})
 
             # Simulasi streaming (pecah teks jadi chunk kecil) agar efek ketikan tetap ada
             chunk_size = 50
             for i in range(0, len(cached_response_text), chunk_size):
                 chunk = cached_response_text[i:i + chunk_size]
-                sse_chunk = json.dumps({"text": chunk})
-                yield f"data: {sse_chunk}\n\n"
+                yield sse_event({"text": chunk})
                 # time.sleep(0.01) # Opsional: jeda dikit biar lebih smooth
 
             yield "data: [DONE]\n\n"
@@ -331,21 +330,19 @@ def stream():
 
                 # Step 6: Generate respons
                 yield send_thinking_status("generating", "Menyusun jawaban...")
-                yield f"data: {json.dumps({'thinking': False})}\n\n"
+                yield sse_event({'thinking': False})
                 
                 # Streaming dari Gemini Service
                 for text_chunk in gemini_service.stream_generate_content(final_prompt):
                     model_response_buffer += text_chunk
-                    sse_chunk = json.dumps({"text": text_chunk})
-                    yield f"data: {sse_chunk}\n\n"
+                    yield sse_event({"text": text_chunk})
                 
                 yield "data: [DONE]\n\n"
                 
             except Exception as e:
                 app.logger.error(f'Error in stream generation: {e}')
                 model_response_buffer = f"Error: {str(e)}"
-                error_msg = json.dumps({'error': {'message': str(e)}})
-                yield f"data: {error_msg}\n\n"
+                yield sse_event({'error': {'message': str(e)}})
             finally:
                 processing_time = int((time.time() - start_time) * 1000)
                 final_log_to_update = db.session.get(PromptLog, log_id)
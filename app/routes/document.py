@@ -13,6 +13,7 @@ import shutil
 from urllib.parse import unquote
 import traceback
 from ..job_utils import check_job_should_stop, cleanup_job_state, update_job_heartbeat
+from ..vector_db import queue_document_vectors_delete
 
 document_bp = Blueprint('document', __name__, url_prefix='/api/documents')
 
@@ -200,7 +201,7 @@ def serve_document_image(filepath):
         format: path
         required: true
         # PERBAIKAN DILAKUKAN DI SINI: Gunakan tanda kutip ganda
-        description: "Path relatif ke file gambar (misal: 'nama_dokumen/page_5.png')."
+        description: "Path relatif ke file gambar (misal: 'nama_dokumen/page_5.jpg')."
     responses:
       200:
         description: Mengembalikan file gambar.
@@ -286,7 +287,7 @@ def serve_document_image(filepath):
         try:
             current_app.logger.info("[FALLBACK] Trying direct file send...")
             from flask import send_file
-            return send_file(full_path, mimetype='image/png')
+            return send_file(full_path)  # mimetype ditebak dari ekstensi (.jpg/.png lama)
         except Exception as e2:
             current_app.logger.error(f"[FALLBACK FAILED] {e2}")
             return jsonify({"error": "Gagal menyajikan gambar.", "details": str(e)}), 500
@@ -339,8 +340,15 @@ def delete_document(document_id):
                     current_app.logger.error(f"Failed to delete image folder {doc_image_folder}: {e}")
         # --- AKHIR LOGIKA BARU ---
 
+        # Chunk dihapus dengan satu statement (tanpa memuat tiap baris & embedding-nya ke ORM);
+        # tetap eksplisit karena database lama belum punya ON DELETE CASCADE
+        DocumentChunk.query.filter_by(document_id=doc.id).delete(synchronize_session=False)
         db.session.delete(doc)
         db.session.commit()
+
+        # Bulk delete tidak memicu listener per chunk, jadi vector-nya dihapus sekaligus, lewat
+        # antrean sinkronisasi yang sama agar upsert chunk yang masih antre tidak menyusul
+        queue_document_vectors_delete(document_id)
         
         return jsonify({"message": f"Dokumen '{filename}' dan semua data terkait berhasil dihapus."}), 200
     except Exception as e:
@@ -1,18 +1,28 @@
-from flask import Blueprint, request, jsonify
-from app.models import db, Feedback, PromptLog, DocumentFeedbackScore
-from sqlalchemy.orm import joinedload
+from flask import Blueprint, request, jsonify, current_app
+from app.models import db, Feedback, PromptLog, DocumentFeedbackScore, FeedbackStatsCounter
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 from datetime import timezone
 from flask_jwt_extended import jwt_required
+from app.helpers import ojsonify
 
 feedback_bp = Blueprint('feedback', __name__, url_prefix='/api')
 
-def format_time_ago(dt):
-    """Mengubah objek datetime menjadi string 'time ago' yang mudah dibaca."""
+# Worker terbatas untuk update skor feedback per entitas: burst POST tidak membuat thread
+# (dan koneksi DB) baru per request, dan antrean tetap diselesaikan saat proses berhenti.
+_feedback_score_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="feedback-score")
+
+def format_time_ago(dt, now=None):
+    """
+    Mengubah objek datetime menjadi string 'time ago' yang mudah dibaca.
+    'now' bisa diberikan sekali oleh pemanggil agar tidak dihitung ulang per item.
+    """
     if not dt:
         return ""
-    now = datetime.datetime.now(timezone.utc)
+    now = now or datetime.datetime.now(timezone.utc)
     diff = now - dt
     
     seconds = diff.total_seconds()
@@ -32,6 +42,101 @@ def format_time_ago(dt):
         return f"{int(months)} bulan yang lalu"
     return f"{int(months / 12)} tahun yang lalu"
 
+# Dispatch table: tipe feedback -> penambahan counter per kolom.
+# Dipilih sekali per request, bukan if/else di setiap baris entitas.
+FEEDBACK_SCORE_DELTAS = {
+    'positive': {'positive_feedback_count': 1, 'negative_feedback_count': 0},
+    'negative': {'positive_feedback_count': 0, 'negative_feedback_count': 1},
+}
+
+def _upsert_feedback_scores(entity_counts, deltas):
+    """
+    Menambah counter feedback untuk banyak entitas sekaligus dengan SATU statement
+    INSERT ... VALUES (...), (...) ON CONFLICT DO UPDATE (aman terhadap request paralel).
+    'entity_counts' berisi {(entity_type, entity_id): jumlah kemunculan}; key harus
+    unik karena Postgres menolak baris yang sama di-update dua kali dalam satu statement.
+    Skor Bayesian smoothing ikut dihitung di sisi DB.
+    """
+    rows = []
+    for (entity_type, entity_id), count in entity_counts.items():
+        positive_delta = deltas['positive_feedback_count'] * count
+        negative_delta = deltas['negative_feedback_count'] * count
+        rows.append({
+            'entity_type': entity_type,
+            'entity_id': entity_id,
+            'positive_feedback_count': positive_delta,
+            'negative_feedback_count': negative_delta,
+            'score': (positive_delta + 1) / (positive_delta + negative_delta + 2)  # (positif + 1) / (total + 2)
+        })
+
+    stmt = insert(DocumentFeedbackScore).values(rows)
+    positive = func.coalesce(DocumentFeedbackScore.positive_feedback_count, 0) + stmt.excluded.positive_feedback_count
+    negative = func.coalesce(DocumentFeedbackScore.negative_feedback_count, 0) + stmt.excluded.negative_feedback_count
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['entity_type', 'entity_id'],
+        set_={
+            'positive_feedback_count': positive,
+            'negative_feedback_count': negative,
+            'score': (positive + 1) / (positive + negative + 2)
+        }
+    )
+    db.session.execute(stmt)
+
+def _build_feedback_stats(counter):
+    """
+    Menyusun payload statistik dari counter dengan aritmatika integer
+    (hasilnya sama dengan int(a / b * 100), tanpa pembagian float berulang).
+    """
+    total_feedback = counter.total
+    positive_feedback = counter.positive
+    total_prompts = counter.total_prompts
+
+    positive_pct = (positive_feedback * 100) // total_feedback if total_feedback else 0
+    negative_pct = ((total_feedback - positive_feedback) * 100) // total_feedback if total_feedback else 0
+    response_pct = (counter.prompts_with_feedback * 100) // total_prompts if total_prompts else 0
+
+    return {
+        'satisfactionRate': positive_pct,
+        'positivePercentage': positive_pct,
+        'negativePercentage': negative_pct,
+        'responseRate': response_pct,
+        'totalReviews': total_feedback
+    }
+
+def update_document_feedback_scores(app, retrieved_items, feedback_type):
+    """
+    Worker background: update skor feedback untuk semua entitas (berita/chunk)
+    yang dipakai oleh prompt_log terkait. 'retrieved_items' adalah isi
+    PromptLog.retrieved_news_ids yang sudah diambil oleh request.
+    """
+    deltas = FEEDBACK_SCORE_DELTAS[feedback_type]
+
+    with app.app_context():
+        try:
+            entity_counts = Counter()
+            for item_ref in retrieved_items:
+                entity_type = item_ref.get('type')
+                entity_id = str(item_ref.get('id'))
+
+                if not entity_type or not entity_id:
+                    continue
+
+                entity_counts[(entity_type, entity_id)] += 1
+
+            if not entity_counts:
+                return
+
+            # Tanpa autoflush: execute() tidak perlu memindai objek dirty,
+            # flush cukup terjadi sekali saat commit.
+            with db.session.no_autoflush:
+                _upsert_feedback_scores(entity_counts, deltas)
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Gagal update skor feedback untuk {len(retrieved_items)} entitas: {e}")
+
 @feedback_bp.route('/feedback', methods=['GET'])
 @jwt_required()
 def get_all_feedback():
@@ -54,6 +159,11 @@ def get_all_feedback():
         type: integer
         description: Jumlah item per halaman.
         default: 10
+      - name: exact
+        in: query
+        type: integer
+        description: "Isi 1 untuk menghitung totalItems dengan COUNT langsung (lebih lambat) alih-alih dari counter statistik."
+        default: 0
     responses:
       200:
         description: Data feedback berhasil diambil.
@@ -72,49 +182,39 @@ def get_all_feedback():
     try:
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 10, type=int)
+        exact_count = request.args.get('exact', 0, type=int) == 1
     
         # --- 1. Kalkulasi Statistik ---
-        total_feedback = db.session.query(func.count(Feedback.id)).scalar() or 0
-        positive_feedback = Feedback.query.filter_by(type='positive').count() or 0
-        
-        total_prompts = db.session.query(func.count(PromptLog.id)).scalar() or 0
-        prompts_with_feedback = db.session.query(func.count(db.distinct(Feedback.prompt_log_id))).scalar() or 0
-
-        stats = {
-            'satisfactionRate': int((positive_feedback / total_feedback) * 100) if total_feedback > 0 else 0,
-            'positivePercentage': int((positive_feedback / total_feedback) * 100) if total_feedback > 0 else 0,
-            'negativePercentage': int(((total_feedback - positive_feedback) / total_feedback) * 100) if total_feedback > 0 else 0,
-            'responseRate': int((prompts_with_feedback / total_prompts) * 100) if total_prompts > 0 else 0,
-            'totalReviews': total_feedback
-        }
-
-        pagination = Feedback.query.options(
-            joinedload(Feedback.prompt_log)
-        ).order_by(Feedback.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        # Dibaca dari counter yang di-maintain saat POST, bukan COUNT per request
+        counter = FeedbackStatsCounter.get_or_rebuild()
+        stats = _build_feedback_stats(counter)
 
         # --- 2. Ambil Daftar Feedback Terbaru ---
-        # Menggunakan joinedload untuk efisiensi query (menghindari N+1 problem)
-        # recent_feedback_query = Feedback.query.options(
-        #     joinedload(Feedback.prompt_log)
-        # ).order_by(Feedback.created_at.desc()).limit(20).all()
-
-        feedback_items_on_page = pagination.items
-
-        formatted_feedback = []
-        for feedback in feedback_items_on_page:
-            if feedback.prompt_log:
-                formatted_feedback.append({
-                    'id': feedback.id,
-                    'type': feedback.type,
-                    'time': format_time_ago(feedback.created_at),
-                    'userPrompt': feedback.prompt_log.user_prompt,
-                    'modelResponse': feedback.prompt_log.model_response,
-                    'comment': feedback.comment
-                })
+        # Hanya ambil kolom skalar yang dibutuhkan (tanpa hidrasi objek ORM).
+        # INNER JOIN ke prompt_logs menyaring feedback tanpa log langsung di DB.
+        pagination = db.session.query(
+            Feedback.id, Feedback.type, Feedback.created_at, Feedback.comment,
+            PromptLog.user_prompt, PromptLog.model_response
+        ).join(PromptLog, Feedback.prompt_log_id == PromptLog.id) \
+            .order_by(Feedback.created_at.desc(), Feedback.id.desc()) \
+            .paginate(page=page, per_page=per_page, error_out=False, count=exact_count)
+
+        # Tanpa ?exact=1, total diambil dari counter (setiap feedback wajib punya
+        # prompt_log, jadi nilainya sama dengan COUNT hasil join) tanpa query tambahan.
+        if not exact_count:
+            pagination.total = counter.total
+
+        now = datetime.datetime.now(timezone.utc)
+        formatted_feedback = [{
+            'id': row.id,
+            'type': row.type,
+            'time': format_time_ago(row.created_at, now),
+            'userPrompt': row.user_prompt,
+            'modelResponse': row.model_response,
+            'comment': row.comment
+        } for row in pagination.items]
         
-        return jsonify({
+        return ojsonify({
             'stats': stats,
             'feedback': {
                 'items': formatted_feedback,
@@ -167,7 +267,7 @@ def handle_feedback():
         description: Feedback berhasil diterima.
       400:
         # PERBAIKAN DILAKUKAN DI SINI: Hapus tanda kutip tunggal (' ')
-        description: type atau session_id tidak diisi. 
+        description: type atau session_id tidak diisi, atau type tidak valid.
       404:
         description: Log percakapan (PromptLog) tidak ditemukan.
     """
@@ -185,6 +285,9 @@ def handle_feedback():
 
     if not feedback_type:
         return jsonify({'error': 'type is required'}), 400
+
+    if feedback_type not in FEEDBACK_SCORE_DELTAS:
+        return jsonify({'error': "type must be 'positive' or 'negative'"}), 400
     
     # --- INI SOLUSINYA ---
     # Kita harus mencari berdasarkan 'sessionId' (ID percakapan)
@@ -193,16 +296,28 @@ def handle_feedback():
     if not sessionId:
         return jsonify({'error': 'session_id is required for feedback'}), 400
 
-    # 1. Cari log TERBARU yang cocok dengan ID PERCAKAPAN
-    prompt_log = PromptLog.query.filter_by(session_id=sessionId)\
-                                .order_by(PromptLog.id.desc())\
-                                .first()
+    # 1. Cari log TERBARU yang cocok dengan ID PERCAKAPAN.
+    #    Hanya ambil kolom yang dibutuhkan (index ix_promptlog_session_id_id).
+    #    Baris prompt di-lock (FOR UPDATE) sampai commit, agar dua POST bersamaan untuk prompt
+    #    yang sama (misal double-click) tidak sama-sama menganggap dirinya feedback pertama.
+    prompt_log = db.session.query(PromptLog.id, PromptLog.retrieved_news_ids)\
+                           .filter(PromptLog.session_id == sessionId)\
+                           .order_by(PromptLog.id.desc())\
+                           .limit(1)\
+                           .with_for_update()\
+                           .first()
 
     if not prompt_log:
         # Jika ini terjadi, berarti 'sessionId' dari frontend tidak ada di DB
         return jsonify({'error': 'PromptLog not found for the given session_id'}), 404
     # --- AKHIR SOLUSI ---
 
+    # Cek sebelum insert: apakah ini feedback pertama untuk prompt_log ini (untuk counter statistik).
+    # Dijalankan setelah lock di atas, jadi feedback dari POST lain yang sudah commit ikut terlihat.
+    is_first_for_prompt = not db.session.query(
+        Feedback.query.filter_by(prompt_log_id=prompt_log.id).exists()
+    ).scalar()
+
     # 2. Buat feedback baru, tautkan ke 'prompt_log.id' (Integer) yang benar
     new_feedback = Feedback(
         prompt_log_id=prompt_log.id,  # <-- Tautkan ke PK integer yang benar
@@ -211,38 +326,19 @@ def handle_feedback():
         session_id=sessionId 
     )
     
-    db.session.add(new_feedback)
+    # Insert feedback + update counter di-flush sekali saat commit
+    with db.session.no_autoflush:
+        db.session.add(new_feedback)
+        FeedbackStatsCounter.record_feedback(feedback_type == 'positive', is_first_for_prompt)
 
-    # 3. (Sisa logika Anda sudah benar)
-    if prompt_log.retrieved_news_ids:
-        for item_ref in prompt_log.retrieved_news_ids:
-            entity_type = item_ref.get('type')
-            entity_id = str(item_ref.get('id'))
-
-            if not entity_type or not entity_id:
-                continue
-
-            feedback_score = DocumentFeedbackScore.query.filter_by(
-                entity_type=entity_type, 
-                entity_id=entity_id
-            ).first()
-
-            if not feedback_score:
-                feedback_score = DocumentFeedbackScore(entity_type=entity_type, entity_id=entity_id)
-                db.session.add(feedback_score)
-            
-            if feedback_score.positive_feedback_count is None:
-                feedback_score.positive_feedback_count = 0
-            if feedback_score.negative_feedback_count is None:
-                feedback_score.negative_feedback_count = 0
-
-            if feedback_type == 'positive':
-                feedback_score.positive_feedback_count += 1
-            else:
-                feedback_score.negative_feedback_count += 1
-            
-            feedback_score.update_score()
-            
     db.session.commit()
 
-    return jsonify({'message': 'Feedback received successfully'}), 201
\ No newline at end of file
+    # 3. Update skor feedback per entitas di background (eventually consistent),
+    #    agar response POST tidak menunggu puluhan UPSERT.
+    if prompt_log.retrieved_news_ids:
+        _feedback_score_executor.submit(
+            update_document_feedback_scores,
+            current_app._get_current_object(), prompt_log.retrieved_news_ids, feedback_type
+        )
+
+    return jsonify({'message': 'Feedback received successfully'}), 201
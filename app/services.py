@@ -3,35 +3,231 @@ import json
 import hashlib
 import logging
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 from google import genai
 from google.genai import types
 import fitz
 import re
 import time
+import bisect
+import random
 import hashlib
-from datetime import datetime  # ✅ TAMBAHKAN INI
-import pytz  # ✅ TAMBAHKAN INI
+from datetime import datetime, timezone
 from typing import List, Dict, Any
 from .models import db, PdfDocument, DocumentChunk, GeminiApiKeyConfig
 from flask import current_app
-from cachetools import TTLCache
+from cachetools import TTLCache, LRUCache
+from sqlalchemy import func
+from concurrent.futures import ThreadPoolExecutor
 import shutil
+import unicodedata
+import sqlite3
+from array import array
+import atexit
+import threading
+import functools
 from .job_utils import check_job_should_stop
 
 logging.basicConfig(level=logging.INFO)
 
+EMBEDDING_MODEL = 'models/text-embedding-004'
+EMBEDDING_URL = "https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:embedContent"
+BATCH_EMBEDDING_URL = "https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:batchEmbedContents"
+# Batas jumlah teks per request batchEmbedContents
+BATCH_EMBED_SIZE = 100
+# Jumlah request batchEmbedContents yang boleh berjalan paralel (jaga agar tetap di bawah QPS Gemini)
+EMBED_CONCURRENCY = max(1, int(os.getenv('EMBED_CONCURRENCY', '3')))
+
+
+def _build_http_session() -> requests.Session:
+    """Session dengan connection pool keep-alive agar handshake TCP/TLS tidak diulang per request."""
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0))
+    return session
+
+
+# Dipakai bersama oleh semua instance EmbeddingService (listener model membuat instance baru
+# per baris, sehingga pool per-instance tidak akan pernah dipakai ulang).
+_http_session = _build_http_session()
+# Tutup koneksi keep-alive di pool saat proses berhenti
+atexit.register(_http_session.close)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_numbered_env_keys(prefix: str, fallback_csv_var: str) -> tuple:
+    """
+    Membaca key bernomor dari environment ({prefix}<n>) dalam satu kali scan os.environ,
+    diurutkan berdasarkan nomornya. Nomor boleh bolong (api_keys.delete_api_key menghapus
+    satu baris .env), jadi yang dikembalikan adalah pasangan (alias, key) dengan alias =
+    nomor aslinya, bukan posisi di list. Jika tidak ada, fallback ke format lama berupa
+    daftar dipisah koma di variabel 'fallback_csv_var' (alias = urutan 1, 2, ...).
+
+    Hasil di-cache (EmbeddingService dibuat per baris oleh listener model); panggil
+    _load_numbered_env_keys.cache_clear() setelah environment berubah (lihat reload_keys).
+    """
+    pattern = re.compile(rf'^{re.escape(prefix)}(\d+)$')
+    numbered = []
+    for name, key_value in os.environ.items():
+        match = pattern.match(name)
+        if match and key_value:
+            numbered.append((int(match.group(1)), match.group(1), key_value))
+
+    if numbered:
+        numbered.sort()
+        return tuple((alias, key_value) for _, alias, key_value in numbered)
+
+    old_keys_str = os.getenv(fallback_csv_var, '')
+    old_keys = [key.strip() for key in old_keys_str.split(',') if key.strip()]
+    return tuple((str(i), key) for i, key in enumerate(old_keys, 1))
+
+
+# Batas atas waktu tunggu dari header Retry-After (detik)
+MAX_RETRY_AFTER = 30
+
+
+def _parse_retry_after(response: requests.Response) -> float | None:
+    """Baca header Retry-After (dalam detik) dan batasi ke MAX_RETRY_AFTER; None jika tidak ada/tidak valid."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return min(max(float(value), 0.0), MAX_RETRY_AFTER)
+    except ValueError:
+        return None
+
+
+# Batas atas backoff eksponensial (detik) dan jeda maksimum antar rotasi key
+MAX_BACKOFF = 20
+ROTATION_PAUSE = 0.1
+# Total waktu tunggu retry maksimum per request embedding (detik)
+MAX_TOTAL_RETRY_WAIT = 60
+
+
+def _jittered_backoff(backoff_factor: float, retry: int) -> float:
+    """
+    Exponential backoff dengan full jitter: acak di [0, min(MAX_BACKOFF, factor^(retry+1))],
+    sehingga worker yang gagal bersamaan tidak retry serentak ke key yang sama.
+    """
+    return random.uniform(0, min(MAX_BACKOFF, backoff_factor ** (retry + 1)))
+
+
+class EmbeddingDiskCache:
+    """
+    Cache embedding persisten (L2) di file SQLite: key digest teks -> vektor float32.
+    Bertahan setelah restart dan dipakai bersama oleh semua worker/proses di server yang sama,
+    sehingga chunk yang sama tidak di-embed ulang ke Gemini. Jika file tidak bisa dibuka,
+    cache dinonaktifkan dan EmbeddingService tetap berjalan tanpa L2.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._disabled = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None and not self._disabled:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                # WAL: pembaca tidak terblokir penulis dari proses lain
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+                conn.commit()
+                self._conn = conn
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding disk cache disabled ({self.path}): {e}")
+                self._disabled = True
+        return self._conn
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, list]:
+        if not keys:
+            return {}
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return {}
+            try:
+                found = {}
+                # Batas parameter SQLite: query per 500 key
+                for start in range(0, len(keys), 500):
+                    part = keys[start:start + 500]
+                    placeholders = ','.join('?' * len(part))
+                    rows = conn.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", part)
+                    for key, vec in rows:
+                        found[key] = array('f', vec).tolist()
+                return found
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding disk cache read failed: {e}")
+                return {}
+
+    def get(self, key: bytes) -> list | None:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: Dict[bytes, list]):
+        if not items:
+            return
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                    [(key, array('f', values).tobytes()) for key, values in items.items()]
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding disk cache write failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# Batas memori cache embedding L1 (byte). Dibatasi per byte, bukan per jumlah entri, dan
+# memakai LRU (bukan TTL): embedding teks yang sama tidak pernah berubah, jadi entri yang
+# sering dipakai tidak perlu kedaluwarsa setiap jam.
+EMBED_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def _embedding_size(values: array) -> int:
+    # Entri disimpan sebagai array float32: 4 byte per elemen + overhead objek
+    return values.itemsize * len(values) + 64
+
+
+# Dipakai bersama oleh semua instance EmbeddingService (listener membuat instance per baris)
+_embedding_memory_cache = LRUCache(maxsize=EMBED_MEMORY_CACHE_BYTES, getsizeof=_embedding_size)
+_embedding_memory_cache_lock = threading.Lock()
+
+# Pool untuk mengirim beberapa request batch embedding sekaligus (lihat EMBED_CONCURRENCY)
+_embedding_fanout_executor = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed-fanout")
+
+_embedding_disk_cache = EmbeddingDiskCache(os.getenv('EMBED_CACHE_PATH', 'data/embedding_cache.sqlite3'))
+atexit.register(_embedding_disk_cache.close)
+
+
 class EmbeddingService:
     def __init__(self):
         self.api_keys = self._load_keys_from_env()
         self.current_key_index = 0
-        self.url = None
+        self.url = EMBEDDING_URL
+        self.headers = None
         self._update_url()
+        self.session = _http_session
+        self._rotate_lock = threading.Lock()
         
-        self.cache = TTLCache(maxsize=1000, ttl=3600)
+        # L1: LRU in-memory bersama semua instance; L2: cache SQLite (lihat EmbeddingDiskCache)
+        self.cache = _embedding_memory_cache
+        self.disk_cache = _embedding_disk_cache
 
     def reload_keys(self):
         """Memuat ulang API keys dari environment dan mereset state."""
         logging.info("Reloading keys for EmbeddingService...")
+        _load_numbered_env_keys.cache_clear()
         self.api_keys = self._load_keys_from_env()
         self.current_key_index = 0
         self._update_url()
@@ -39,57 +235,68 @@ class EmbeddingService:
 
     def _load_keys_from_env(self):
         """Load API keys dari environment variables"""
-        keys = []
-        i = 1
-        while True:
-            env_key = f"GEMINI_API_KEY_{i}"
-            key_value = os.getenv(env_key)
-            if not key_value:
-                break
-            keys.append(key_value)
-            i += 1
-        
-        if not keys:
-            old_keys_str = os.getenv('GEMINI_API_KEYS', '')
-            old_keys_list = [key.strip() for key in old_keys_str.split(',') if key.strip()]
-            keys.extend(old_keys_list)
-        
+        keys = [key for _, key in _load_numbered_env_keys('GEMINI_API_KEY_', 'GEMINI_API_KEYS')]
         logging.info(f"Loaded {len(keys)} API keys for EmbeddingService")
         return keys
 
     def _update_url(self):
-        """Update URL dengan API key saat ini"""
+        """
+        Update header API key saat ini. Key dikirim lewat header 'x-goog-api-key'
+        (bukan query string) sehingga URL tetap sama dan pool koneksi tetap terpakai
+        meskipun key dirotasi.
+        """
         if self.current_key_index < len(self.api_keys):
             current_key = self.api_keys[self.current_key_index]
-            self.url = f"https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:embedContent?key={current_key}"
+            self.url = EMBEDDING_URL
+            self.headers = {'x-goog-api-key': current_key, 'Content-Type': 'application/json'}
         else:
             self.url = None
+            self.headers = None
             logging.error("No valid API keys available for EmbeddingService")
 
-    def _rotate_key(self):
-        """Rotasi ke API key berikutnya"""
-        if self.current_key_index < len(self.api_keys) - 1:
-            self.current_key_index += 1
-            self._update_url()
-            logging.info(f"Rotated to API key index: {self.current_key_index}")
-            return True  # ✅ Berhasil rotate
-        else:
-            logging.error("No more API keys to rotate to")
-            self.url = None
-            return False  # ✅ Tidak ada key lagi
-
-    def generate(self, text: str) -> list | None:
-        if not text:
-            return None
-
-        # Check cache
-        if text in self.cache:
-            logging.info(f"Embedding cache hit for text: '{text[:50]}...'")
-            return self.cache[text]
-
+    def _rotate_key(self, from_index: int | None = None):
+        """
+        Rotasi ke API key berikutnya. 'from_index' adalah index key yang gagal; jika thread lain
+        (lihat generate_batch) sudah merotasi dari key itu, rotasi tidak diulang agar key tidak terlewat.
+        """
+        # Jeda kecil agar rotasi tidak berputar cepat saat semua key sedang di-throttle
+        time.sleep(random.uniform(0, ROTATION_PAUSE))
+        with self._rotate_lock:
+            if from_index is not None and from_index != self.current_key_index:
+                return self.url is not None
+            if self.current_key_index < len(self.api_keys) - 1:
+                self.current_key_index += 1
+                self._update_url()
+                logging.info(f"Rotated to API key index: {self.current_key_index}")
+                return True  # ✅ Berhasil rotate
+            else:
+                logging.error("No more API keys to rotate to")
+                self.url = None
+                self.headers = None
+                return False  # ✅ Tidak ada key lagi
+
+    @staticmethod
+    def _sleep_within_budget(wait_time: float, deadline: float) -> bool:
+        """Tidur sebelum retry jika masih dalam batas MAX_TOTAL_RETRY_WAIT; False jika batas terlampaui."""
+        if time.monotonic() + wait_time > deadline:
+            logging.error(f"Embedding retry budget ({MAX_TOTAL_RETRY_WAIT}s) exceeded, giving up")
+            return False
+        time.sleep(wait_time)
+        return True
+
+    def _post_with_retry(self, endpoint_url: str, payload: dict, fields: str | None = None) -> dict | None:
+        """
+        POST ke endpoint embedding dengan retry per key dan rotasi key saat 429/5xx.
+        Mengembalikan body JSON jika sukses, atau None jika semua key gagal.
+        'fields' (field mask Google API) membatasi isi respons ke field yang dibutuhkan saja.
+        """
+        params = {'fields': fields} if fields else None
         if not self.api_keys or not self.url:
             logging.error("Embedding generation failed: No API keys available")
             return None
+        # Serialisasi sekali dengan orjson (langsung bytes), dipakai ulang untuk semua retry/rotasi key
+        body = orjson.dumps(payload)
+        retry_deadline = time.monotonic() + MAX_TOTAL_RETRY_WAIT
         
         max_key_attempts = len(self.api_keys)  # ✅ Coba semua keys
         retries_per_key = 2  # ✅ Retry per key dikurangi
@@ -97,61 +304,207 @@ class EmbeddingService:
         
         for key_attempt in range(max_key_attempts):  # ✅ Loop untuk setiap key
             for retry in range(retries_per_key):
+                key_index, headers = self.current_key_index, self.headers
+                if headers is None:
+                    return None  # Key sudah habis (dirotasi oleh thread lain)
                 try:
-                    response = requests.post(
-                        self.url,
-                        json={
-                            'model': 'models/text-embedding-004', 
-                            'content': {'parts': [{'text': text}]}
-                        },
+                    response = self.session.post(
+                        endpoint_url,
+                        headers=headers,
+                        params=params,
+                        data=body,
                         timeout=30
                     )
                     
                     if response.status_code == 429:
-                        logging.warning(f"API key {self.current_key_index} quota exceeded (429). Rotating...")
-                        if not self._rotate_key():
+                        retry_after = _parse_retry_after(response)
+                        is_last_key = key_index >= len(self.api_keys) - 1
+                        # Key terakhir: tunggu sesuai Retry-After lalu coba sekali lagi sebelum menyerah
+                        if is_last_key and retry_after is not None and retry < retries_per_key - 1:
+                            logging.warning(f"API key {key_index} rate limited (429). Retrying in {retry_after:.1f}s...")
+                            if not self._sleep_within_budget(retry_after, retry_deadline):
+                                return None
+                            continue
+                        logging.warning(f"API key {key_index} quota exceeded (429). Rotating...")
+                        if not self._rotate_key(key_index):
                             return None  # Semua keys habis
                         break  # Keluar dari retry loop, coba key berikutnya
                     
                     if response.status_code >= 500:
                         logging.warning(f"Server error {response.status_code}. Retrying...")
                         if retry < retries_per_key - 1:
-                            wait_time = backoff_factor ** (retry + 1)
-                            time.sleep(wait_time)
+                            wait_time = max(_jittered_backoff(backoff_factor, retry), _parse_retry_after(response) or 0.0)
+                            if not self._sleep_within_budget(wait_time, retry_deadline):
+                                return None
                             continue
                         else:
                             # Coba key berikutnya
-                            if not self._rotate_key():
+                            if not self._rotate_key(key_index):
                                 return None
                             break
                     
                     response.raise_for_status() 
-                    result = response.json()
-                    embedding_values = result.get('embedding', {}).get('values')
-
-                    if embedding_values:
-                        self.cache[text] = embedding_values
-                        return embedding_values
-                    else:
-                        logging.error("No embedding values in response")
-                        return None
+                    # orjson jauh lebih cepat untuk body berisi ratusan float per embedding
+                    return orjson.loads(response.content)
                         
-                except requests.exceptions.RequestException as e:
+                except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
                     logging.error(f"Embedding API request failed: {e}")
                     
                     if retry < retries_per_key - 1:
-                        wait_time = backoff_factor ** (retry + 1)
-                        logging.warning(f"Retrying in {wait_time} seconds...")
-                        time.sleep(wait_time)
+                        wait_time = _jittered_backoff(backoff_factor, retry)
+                        logging.warning(f"Retrying in {wait_time:.1f} seconds...")
+                        if not self._sleep_within_budget(wait_time, retry_deadline):
+                            return None
                     else:
                         # Coba key berikutnya
-                        if not self._rotate_key():
+                        if not self._rotate_key(key_index):
                             return None
                         break
         
         logging.error("All API keys exhausted for embedding generation")
         return None
 
+    def _cache_get(self, cache_key: bytes) -> list | None:
+        with _embedding_memory_cache_lock:
+            packed = self.cache.get(cache_key)
+        return packed.tolist() if packed is not None else None
+
+    def _cache_put(self, cache_key: bytes, values: list):
+        # Disimpan sebagai float32 (sama seperti cache disk): ~8x lebih hemat dari list of float
+        packed = array('f', values)
+        with _embedding_memory_cache_lock:
+            self.cache[cache_key] = packed
+
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        """
+        Key cache berupa digest BLAKE2b 16 byte, bukan teks utuh, agar key kecil dan
+        perbandingannya O(1). Risiko tabrakan 128-bit dapat diabaikan.
+        Teks dinormalisasi dulu (NFKC, spasi dirapatkan, casefold) supaya variasi spasi/huruf
+        besar tetap kena cache; yang dikirim ke API tetap teks aslinya.
+        Nama model ikut di-hash agar vektor lama di cache disk tidak terpakai setelah
+        EMBEDDING_MODEL diganti.
+        """
+        normalized = unicodedata.normalize('NFKC', _WS_RE.sub(' ', text)).strip().casefold()
+        return hashlib.blake2b(f"{EMBEDDING_MODEL}\n{normalized}".encode('utf-8'), digest_size=16).digest()
+
+    def generate(self, text: str) -> list | None:
+        if not text:
+            return None
+
+        # Check cache
+        cache_key = self._cache_key(text)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logging.info(f"Embedding cache hit for text: '{text[:50]}...'")
+            return cached
+
+        cached = self.disk_cache.get(cache_key)
+        if cached is not None:
+            self._cache_put(cache_key, cached)
+            return cached
+
+        result = self._post_with_retry(EMBEDDING_URL, {
+            'model': EMBEDDING_MODEL,
+            'content': {'parts': [{'text': text}]}
+        }, fields='embedding.values')
+        if result is None:
+            return None
+
+        embedding_values = result.get('embedding', {}).get('values')
+        if embedding_values:
+            self._cache_put(cache_key, embedding_values)
+            self.disk_cache.set_many({cache_key: embedding_values})
+            return embedding_values
+
+        logging.error("No embedding values in response")
+        return None
+
+    def _embed_group(self, group: List[int], texts: List[str], cache_keys: List[bytes]) -> Dict[int, list] | None:
+        """
+        Satu request batchEmbedContents untuk teks pada index 'group'. Mengembalikan
+        {index: embedding} (lalu disimpan ke cache L1 & L2), atau None jika semua key habis.
+        """
+        result = self._post_with_retry(BATCH_EMBEDDING_URL, {
+            'requests': [
+                {'model': EMBEDDING_MODEL, 'content': {'parts': [{'text': texts[i]}]}}
+                for i in group
+            ]
+        }, fields='embeddings.values')
+        if result is None:
+            return None
+
+        embeddings = result.get('embeddings', [])
+        if len(embeddings) != len(group):
+            logging.error(f"Batch embedding returned {len(embeddings)} vectors for {len(group)} texts")
+            return {}
+
+        embedded = {}
+        new_entries = {}
+        for i, embedding in zip(group, embeddings):
+            embedding_values = embedding.get('values')
+            if embedding_values:
+                self._cache_put(cache_keys[i], embedding_values)
+                new_entries[cache_keys[i]] = embedding_values
+                embedded[i] = embedding_values
+        self.disk_cache.set_many(new_entries)
+        return embedded
+
+    def generate_batch(self, texts: List[str]) -> List[list | None]:
+        """
+        Generate embedding untuk banyak teks sekaligus via endpoint batchEmbedContents
+        (maksimal BATCH_EMBED_SIZE teks per request). Urutan hasil sama dengan 'texts';
+        teks kosong atau yang gagal di-embed menghasilkan None. Cache per teks tetap dipakai.
+        """
+        results: List[list | None] = [None] * len(texts)
+        cache_keys: List[bytes | None] = [None] * len(texts)
+        missing_indices = []
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            cache_keys[i] = self._cache_key(text)
+            cached = self._cache_get(cache_keys[i])
+            if cached is not None:
+                results[i] = cached
+            else:
+                missing_indices.append(i)
+
+        # Cek L2 (disk) untuk semua yang tidak ada di L1 dengan satu query
+        if missing_indices:
+            from_disk = self.disk_cache.get_many([cache_keys[i] for i in missing_indices])
+            if from_disk:
+                still_missing = []
+                for i in missing_indices:
+                    cached = from_disk.get(cache_keys[i])
+                    if cached is not None:
+                        self._cache_put(cache_keys[i], cached)
+                        results[i] = cached
+                    else:
+                        still_missing.append(i)
+                missing_indices = still_missing
+
+        groups = [missing_indices[start:start + BATCH_EMBED_SIZE]
+                  for start in range(0, len(missing_indices), BATCH_EMBED_SIZE)]
+        if len(groups) > 1 and EMBED_CONCURRENCY > 1:
+            # Beberapa request batch dikirim paralel; tiap request menunggu jaringan, bukan CPU
+            outcomes = _embedding_fanout_executor.map(
+                lambda group: self._embed_group(group, texts, cache_keys), groups)
+        else:
+            outcomes = (self._embed_group(group, texts, cache_keys) for group in groups)
+
+        for embedded in outcomes:
+            if embedded is None:
+                # Semua key habis: batch berikutnya juga akan gagal
+                break
+            for i, embedding_values in embedded.items():
+                results[i] = embedding_values
+
+        return results
+
+
+# Interval (detik) penulisan counter request Gemini yang diakumulasi di memori
+COUNTER_FLUSH_INTERVAL = 10
+
 
 class GeminiService:
     _instance = None
@@ -168,9 +521,20 @@ class GeminiService:
         self._initialized = True 
         
         logging.info("Initializing GeminiService Singleton...")
-        self.api_keys = self._load_keys_from_env()
+        self._load_keys_from_env()
         self.current_key_index = 0
         self.client = None
+        # index key -> genai.Client yang sudah dibuat, agar rotasi bolak-balik tidak membangun ulang client
+        self._clients: Dict[int, Any] = {}
+        # key_alias -> id GeminiApiKeyConfig (atau None jika belum ada config). Yang di-cache
+        # hanya id-nya, bukan objek ORM, karena session berbeda per request/thread.
+        self._key_config_ids = TTLCache(maxsize=64, ttl=60)
+        # index key -> waktu (monotonic) terakhir last_used ditulis ke database
+        self._last_used_written: Dict[int, float] = {}
+        # key_alias -> [jumlah request, jumlah gagal] yang belum ditulis ke database
+        self._request_deltas: Dict[str, list] = {}
+        self._counter_lock = threading.Lock()
+        self._last_counter_flush = time.monotonic()
         
         if not self.api_keys:
             logging.error("No Gemini API keys found in environment variables")
@@ -181,26 +545,25 @@ class GeminiService:
     def reload_keys(self):
         """Memuat ulang API keys dari environment dan mereset state."""
         logging.info("Reloading keys for GeminiService...")
-        self.api_keys = self._load_keys_from_env()
+        self._flush_request_counters(force=True)
+        _load_numbered_env_keys.cache_clear()
+        self._load_keys_from_env()
         self.current_key_index = 0
+        self._clients.clear()
+        self._key_config_ids.clear()
+        self._last_used_written.clear()
         self._initialize_client()
         logging.info(f"Successfully reloaded {len(self.api_keys)} keys.")
 
     def _load_keys_from_env(self):
-        """Load API keys dari environment variables dengan lebih robust."""
-        keys = []
-        gemini_env_keys = {key: value for key, value in os.environ.items() if key.startswith('GEMINI_API_KEY_')}
-        sorted_keys = sorted(gemini_env_keys.items(), key=lambda item: int(item[0].split('_')[-1]))
-        keys = [value for key, value in sorted_keys]
-        
-        # Fallback ke format lama
-        if not keys:
-            old_keys_str = os.getenv('GEMINI_API_KEYS', '')
-            old_keys_list = [key.strip() for key in old_keys_str.split(',') if key.strip()]
-            keys.extend(old_keys_list)
-        
-        logging.info(f"Loaded {len(keys)} API keys for GeminiService")
-        return keys
+        """
+        Load API keys dari environment variables ke self.api_keys, beserta alias aslinya
+        (nomor di GEMINI_API_KEY_<n>) di self.key_aliases pada index yang sama.
+        """
+        entries = _load_numbered_env_keys('GEMINI_API_KEY_', 'GEMINI_API_KEYS')
+        self.key_aliases = [alias for alias, _ in entries]
+        self.api_keys = [key for _, key in entries]
+        logging.info(f"Loaded {len(self.api_keys)} API keys for GeminiService")
 
     def _get_current_key_config(self):
         """Dapatkan config untuk key yang sedang digunakan"""
@@ -208,8 +571,14 @@ class GeminiService:
             return None
             
         try:
-            alias = f"{self.current_key_index + 1}"
+            alias = self.key_aliases[self.current_key_index]
+            if alias in self._key_config_ids:
+                config_id = self._key_config_ids[alias]
+                # Lookup primary key: tanpa query jika objek sudah ada di identity map session
+                return db.session.get(GeminiApiKeyConfig, config_id) if config_id is not None else None
+
             config = GeminiApiKeyConfig.query.filter_by(key_alias=alias).first()
+            self._key_config_ids[alias] = config.id if config else None
             return config
         except Exception as e:
             logging.error(f"Error getting key config: {e}")
@@ -233,13 +602,18 @@ class GeminiService:
                     logging.warning(f"API key {self.current_key_index} still has quota exceeded. Skipping...")
                     return False
             
-            current_key = self.api_keys[self.current_key_index]
-            self.client = genai.Client(api_key=current_key)
+            if self.current_key_index not in self._clients:
+                current_key = self.api_keys[self.current_key_index]
+                self._clients[self.current_key_index] = genai.Client(api_key=current_key)
+            self.client = self._clients[self.current_key_index]
             
-            # Update last_used timestamp di database
-            if key_config:
-                key_config.last_used = datetime.now(pytz.utc)
+            # Update last_used timestamp di database (maksimal sekali per menit per key)
+            now = time.monotonic()
+            last_written = self._last_used_written.get(self.current_key_index)
+            if key_config and (last_written is None or now - last_written > 60):
+                key_config.last_used = datetime.now(timezone.utc)
                 db.session.commit()
+                self._last_used_written[self.current_key_index] = now
                 
             logging.info(f"Gemini Client initialized with API key index: {self.current_key_index}")
             return True
@@ -249,6 +623,50 @@ class GeminiService:
             logging.error(f"Failed to initialize Gemini Client with key index {self.current_key_index}: {e}")
             return False
 
+    def _record_request_result(self, success: bool):
+        """
+        Catat hasil request di memori (pengganti mark_successful_request/mark_failed_request
+        per panggilan); ditulis ke database paling sering tiap COUNTER_FLUSH_INTERVAL detik.
+        """
+        if self.current_key_index >= len(self.key_aliases):
+            return
+        alias = self.key_aliases[self.current_key_index]
+        with self._counter_lock:
+            delta = self._request_deltas.setdefault(alias, [0, 0])
+            delta[0] += 1
+            if not success:
+                delta[1] += 1
+        self._flush_request_counters()
+
+    def _flush_request_counters(self, force: bool = False):
+        """Tulis akumulasi counter request ke gemini_api_key_configs dalam satu transaksi."""
+        now = time.monotonic()
+        with self._counter_lock:
+            if not force and now - self._last_counter_flush < COUNTER_FLUSH_INTERVAL:
+                return
+            deltas, self._request_deltas = self._request_deltas, {}
+            self._last_counter_flush = now
+
+        if not deltas:
+            return
+
+        try:
+            last_used = datetime.now(timezone.utc)
+            for alias, (total, failed) in deltas.items():
+                db.session.execute(
+                    db.update(GeminiApiKeyConfig)
+                    .where(GeminiApiKeyConfig.key_alias == alias)
+                    .values(
+                        total_requests=GeminiApiKeyConfig.total_requests + total,
+                        failed_requests=GeminiApiKeyConfig.failed_requests + failed,
+                        last_used=last_used
+                    )
+                )
+            db.session.commit()
+        except Exception as db_error:
+            db.session.rollback()
+            logging.warning(f"Could not flush request counters: {db_error}")
+
     def _rotate_key(self):
         """Rotasi ke API key berikutnya"""
         try:
@@ -282,27 +700,19 @@ class GeminiService:
                 )
                 
                 # Tandai request sukses
-                try:
-                    key_config = self._get_current_key_config()
-                    if key_config:
-                        key_config.mark_successful_request()
-                except Exception as db_error:
-                    logging.warning(f"Could not mark successful request: {db_error}")
+                self._record_request_result(success=True)
                 
                 for chunk in response:
-                    if hasattr(chunk, 'text') and chunk.text:
-                        yield chunk.text
+                    # Satu kali akses atribut per chunk (hasattr + .text = dua kali)
+                    text = getattr(chunk, 'text', None)
+                    if text:
+                        yield text
                 
                 return  # Streaming selesai sukses
                 
             except Exception as e:
                 # Tandai request gagal
-                try:
-                    key_config = self._get_current_key_config()
-                    if key_config:
-                        key_config.mark_failed_request()
-                except Exception as db_error:
-                    logging.warning(f"Could not mark failed request: {db_error}")
+                self._record_request_result(success=False)
                 
                 error_str = str(e).lower()
                 
@@ -340,23 +750,13 @@ class GeminiService:
                 )
                 
                 # Tandai request sukses
-                try:
-                    key_config = self._get_current_key_config()
-                    if key_config:
-                        key_config.mark_successful_request()
-                except Exception as db_error:
-                    logging.warning(f"Could not mark successful request: {db_error}")
+                self._record_request_result(success=True)
                 
-                return response.text
+                return getattr(response, 'text', None)
                 
             except Exception as e:
                 # Tandai request gagal
-                try:
-                    key_config = self._get_current_key_config()
-                    if key_config:
-                        key_config.mark_failed_request()
-                except Exception as db_error:
-                    logging.warning(f"Could not mark failed request: {db_error}")
+                self._record_request_result(success=False)
                 
                 error_str = str(e).lower()
                 
@@ -372,86 +772,206 @@ class GeminiService:
         return None
 
 
+# Pola regex deteksi halaman, dikompilasi sekali saat modul dimuat.
+# Judul halaman navigasi/pustaka digabung jadi satu alternation agar teks cukup dipindai sekali.
+_NAV_RE = re.compile(
+    r'^\s*daftar\s+(?:isi|tabel|gambar|grafik|lampiran|pustaka)'
+    r'|table\s+of\s+contents|list\s+of\s+(?:tables|figures|graphs|appendices)'
+    r'|references|bibliography|referensi'
+)
+_TABLE_RE = re.compile(
+    r'(?:tabel|table)\s+\d[\d.]*|lanjutan\s+tabel|tabel\s+[\d.]+\s*\(lanjutan\)|^(?:tabel|table)$',
+    re.IGNORECASE | re.MULTILINE
+)
+_LAMPIRAN_RE = re.compile(r'^\s*lampiran|appendix')
+_COL_NUM_RE = re.compile(r'\(\s*\d+\s*\)')
+_DOT_LINE_RE = re.compile(r'\.{5,}\s*\d+\s*$')
+_WS_RE = re.compile(r'\s+')
+_MULTISPACE_RE = re.compile(r'\s{2,}')
+# Akhir kalimat: tanda baca yang diikuti spasi/akhir teks (titik ribuan seperti "1.234" tidak ikut)
+_SENT_END_RE = re.compile(r'[.!?](?=\s|$)')
+
+
+# Hasil deteksi halaman bersifat murni (hanya bergantung pada teks & apakah halaman pertama),
+# jadi bisa di-memo lintas dokumen: kop, formulir, dan lampiran standar sering identik.
+PAGE_DETECTION_CACHE_SIZE = 4096
+_page_detection_cache = LRUCache(maxsize=PAGE_DETECTION_CACHE_SIZE)
+_page_detection_cache_lock = threading.Lock()
+
+
 class RobustTableDetector:
+    # Dibuat sekali untuk semua halaman; 1.75x masih cukup tajam untuk tabel
+    _ZOOM_MATRIX = fitz.Matrix(1.75, 1.75)
+    # Kualitas JPEG screenshot halaman (JPEG jauh lebih cepat di-encode daripada PNG)
+    _JPEG_QUALITY = 85
+    # Halaman dengan teks sependek ini tidak di-dedup (mis. halaman gambar tanpa teks)
+    _DEDUP_MIN_TEXT_LEN = 50
+
     def __init__(self):
         self.output_dir = current_app.config['PDF_IMAGES_DIRECTORY']
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
+        # (base_filename, hash teks halaman) -> path file screenshot yang sudah dirender
+        self._screenshot_by_text: Dict[tuple, str] = {}
+        self._created_dirs: set = set()
             
-    def _save_page_screenshot(self, page: fitz.Page, base_filename: str, page_num: int) -> str | None:
-        try:
-            document_specific_dir = os.path.join(self.output_dir, base_filename)
+    def _get_document_dir(self, base_filename: str) -> str:
+        """Folder gambar per dokumen; makedirs cukup sekali per dokumen, bukan per halaman."""
+        document_specific_dir = os.path.join(self.output_dir, base_filename)
+        if document_specific_dir not in self._created_dirs:
             os.makedirs(document_specific_dir, exist_ok=True)
+            self._created_dirs.add(document_specific_dir)
+        return document_specific_dir
+
+    @staticmethod
+    def _text_digest(raw_text: str) -> bytes:
+        """Digest BLAKE2b 16 byte dari teks halaman, dipakai untuk memo deteksi & dedup screenshot."""
+        return hashlib.blake2b(raw_text.encode('utf-8'), digest_size=16).digest()
+
+    def _save_page_screenshot(self, page: fitz.Page, base_filename: str, page_num: int,
+                              raw_text: str | None = None, text_digest: bytes | None = None) -> str | None:
+        """
+        Render halaman ke JPEG. Jika 'raw_text' diberikan dan halaman lain di dokumen yang sama
+        punya teks identik (kop surat, formulir berulang), file lama di-hardlink tanpa render ulang.
+        """
+        try:
+            document_specific_dir = self._get_document_dir(base_filename)
 
-            image_filename = f"page_{page_num}.png"
+            image_filename = f"page_{page_num}.jpg"
             output_path = os.path.join(document_specific_dir, image_filename)
             web_accessible_path = f'pdf_images/{base_filename}/{image_filename}'
-            
-            if os.path.exists(output_path):
+
+            dedup_key = None
+            if raw_text and len(raw_text.strip()) >= self._DEDUP_MIN_TEXT_LEN:
+                if text_digest is None:
+                    text_digest = self._text_digest(raw_text)
+                dedup_key = (base_filename, text_digest)
+                existing_path = self._screenshot_by_text.get(dedup_key)
+                if existing_path:
+                    try:
+                        os.link(existing_path, output_path)
+                    except FileExistsError:
+                        return web_accessible_path
+                    except OSError:
+                        shutil.copyfile(existing_path, output_path)
+                    logging.info(f"Screenshot halaman {page_num} identik, memakai ulang {existing_path}")
+                    return web_accessible_path
+
+            # O_EXCL: gagal jika file sudah ada (tanpa stat terpisah), sekaligus memastikan
+            # hanya satu worker yang menulis file ini
+            try:
+                fd = os.open(output_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
                 return web_accessible_path
 
-            matrix = fitz.Matrix(2, 2)
-            pix = page.get_pixmap(matrix=matrix)
-            pix.save(output_path)
+            try:
+                with os.fdopen(fd, "wb") as fo:
+                    pix = page.get_pixmap(matrix=self._ZOOM_MATRIX, alpha=False)
+                    jpg_bytes = pix.tobytes("jpg", jpg_quality=self._JPEG_QUALITY)
+                    # Lepas buffer pixmap mentah (w*h*3 byte) sebelum menulis, jangan tunggu GC
+                    pix = None
+                    fo.write(jpg_bytes)
+            except Exception:
+                # Jangan tinggalkan file kosong/rusak yang nanti dianggap cache
+                os.unlink(output_path)
+                raise
             logging.info(f"Screenshot disimpan di: {output_path}")
+            if dedup_key:
+                self._screenshot_by_text[dedup_key] = output_path
             
             return web_accessible_path
         except Exception as e:
             logging.error(f"Gagal menyimpan gambar untuk halaman {page_num}: {e}")
             return None
 
-    def _clean_text_for_rag(self, raw_text: str) -> str:
-        lines = raw_text.strip().split('\n')
-        cleaned_lines = [re.sub(r'\s{2,}', ' ', line.strip()) for line in lines if line.strip()]
-        return '\n'.join(cleaned_lines)
-
-    def _is_excluded_page(self, raw_text: str, page_num: int) -> bool:
-        lines = raw_text.strip().split('\n')
-        first_few_lines = '\n'.join(lines[:5]).lower()
-        navigation_titles = [
-            r'^\s*daftar\s+isi', r'table\s+of\s+contents', r'^\s*daftar\s+tabel', 
-            r'list\s+of\s+tables', r'^\s*daftar\s+gambar', r'list\s+of\s+figures',
-            r'^\s*daftar\s+grafik', r'list\s+of\s+graphs', r'^\s*daftar\s+lampiran', 
-            r'list\s+of\s+appendices'
-        ]
-        for title_pattern in navigation_titles:
-            if re.search(title_pattern, first_few_lines): return True
-        dot_pattern_lines = [line for line in lines if re.search(r'\.{5,}\s*\d+\s*$', line)]
-        if len(lines) > 5 and len(dot_pattern_lines) / len(lines) > 0.4: return True
-        if re.search(r'^\s*daftar\s+pustaka|references|bibliography|referensi', first_few_lines): return True
-        if page_num == 1 and len(lines) < 10: return True
+    @staticmethod
+    def _split_lines(raw_text: str) -> List[str]:
+        """Pecah teks halaman (sudah di-strip) per baris; hasilnya dipakai bersama oleh detektor & cleaner."""
+        return raw_text.strip().split('\n')
+
+    def _clean_text_for_rag(self, raw_text: str, lines: List[str] | None = None) -> str:
+        if lines is None:
+            lines = self._split_lines(raw_text)
+        # Setiap baris cukup di-strip sekali (walrus), lalu spasi berlebih dirapikan
+        return '\n'.join(_MULTISPACE_RE.sub(' ', stripped) for line in lines if (stripped := line.strip()))
+
+    @staticmethod
+    def _first_few_lines(lines: List[str]) -> str:
+        """Lima baris pertama (lowercase), tempat judul halaman biasanya berada."""
+        return '\n'.join(lines[:5]).lower()
+
+    def _is_excluded_page(self, raw_text: str, page_num: int, lines: List[str] | None = None,
+                          first_few_lines: str | None = None) -> bool:
+        # Cek murah lebih dulu sebelum regex
         if len(raw_text.strip()) < 50: return True
+        if lines is None:
+            lines = self._split_lines(raw_text)
+        if page_num == 1 and len(lines) < 10: return True
+        if first_few_lines is None:
+            first_few_lines = self._first_few_lines(lines)
+        # Daftar isi/tabel/gambar/grafik/lampiran dan daftar pustaka
+        if _NAV_RE.search(first_few_lines): return True
+        # Halaman daftar isi: > 40% baris berakhiran "...... 12"; berhenti begitu ambang terlewati
+        if len(lines) > 5:
+            max_dot_lines = len(lines) * 0.4
+            dot_lines = 0
+            for line in lines:
+                # '.....' in line: cek substring murah, regex hanya untuk baris kandidat
+                if '.....' in line and _DOT_LINE_RE.search(line):
+                    dot_lines += 1
+                    if dot_lines > max_dot_lines: return True
         return False
 
     def _detect_table_keyword(self, text: str) -> tuple[bool, str]:
-        text_lower = text.lower()
-        table_patterns = [
-            r'tabel\s+\d[\d\.]*', r'table\s+\d[\d\.]*', r'lanjutan\s+tabel',
-            r'tabel\s+[\d\.]+\s*\(lanjutan\)', r'^tabel$', r'^table$'
-        ]
-        for pattern in table_patterns:
-            if re.search(pattern, text_lower, re.MULTILINE):
-                return True, "table_keyword_found"
+        if _TABLE_RE.search(text):
+            return True, "table_keyword_found"
         return False, "no_table_keyword"
 
-    def _detect_lampiran_keyword(self, text: str) -> tuple[bool, str]:
-        first_few_lines = '\n'.join(text.strip().split('\n')[:5]).lower()
-        if re.search(r'^\s*lampiran|appendix', first_few_lines):
+    def _detect_lampiran_keyword(self, text: str, lines: List[str] | None = None,
+                                 first_few_lines: str | None = None) -> tuple[bool, str]:
+        if first_few_lines is None:
+            first_few_lines = self._first_few_lines(lines if lines is not None else self._split_lines(text))
+        if _LAMPIRAN_RE.search(first_few_lines):
             return True, "lampiran_keyword_found"
         return False, "no_lampiran_keyword"
 
     def _detect_column_numbering(self, text: str) -> tuple[bool, str]:
-        matches = re.findall(r'\(\s*\d+\s*\)', text)
-        if len(set(matches)) >= 2:
-            return True, "flexible_column_numbering_found"
+        # Cukup dua penomoran kolom berbeda, jadi berhenti begitu yang kedua ditemukan
+        seen = set()
+        for match in _COL_NUM_RE.finditer(text):
+            seen.add(match.group(0))
+            if len(seen) >= 2:
+                return True, "flexible_column_numbering_found"
         return False, "no_strong_column_numbering"
 
-    def _detect_table_page(self, raw_text: str, page_num: int) -> tuple[bool, str]:
-        if self._is_excluded_page(raw_text, page_num):
+    def _detect_table_page(self, raw_text: str, page_num: int, lines: List[str] | None = None,
+                           text_digest: bytes | None = None) -> tuple[bool, str]:
+        """
+        Klasifikasi halaman. Jika 'text_digest' diberikan, hasil untuk teks yang sama
+        diambil dari memo (_page_detection_cache) tanpa menjalankan regex lagi.
+        """
+        if text_digest is None:
+            return self._classify_page(raw_text, page_num, lines)
+
+        memo_key = (text_digest, page_num == 1)
+        with _page_detection_cache_lock:
+            cached = _page_detection_cache.get(memo_key)
+        if cached is not None:
+            return cached
+        result = self._classify_page(raw_text, page_num, lines)
+        with _page_detection_cache_lock:
+            _page_detection_cache[memo_key] = result
+        return result
+
+    def _classify_page(self, raw_text: str, page_num: int, lines: List[str] | None = None) -> tuple[bool, str]:
+        if lines is None:
+            lines = self._split_lines(raw_text)
+        first_few_lines = self._first_few_lines(lines)
+        if self._is_excluded_page(raw_text, page_num, lines, first_few_lines):
             return False, "excluded_page"
         has_table_kw, _ = self._detect_table_keyword(raw_text)
-        has_lampiran_kw, _ = self._detect_lampiran_keyword(raw_text)
-        has_any_keyword = has_table_kw or has_lampiran_kw
+        # Kata kunci lampiran hanya menentukan hasil jika tidak ada kata kunci tabel
+        has_any_keyword = has_table_kw or self._detect_lampiran_keyword(raw_text, lines, first_few_lines)[0]
         has_structure, _ = self._detect_column_numbering(raw_text)
         if has_any_keyword and has_structure:
             return True, "table_with_structure" if has_table_kw else "lampiran_with_structure"
@@ -463,39 +983,138 @@ class RobustTableDetector:
 
     def extract_and_label_pages(self, pdf_path: str) -> List[Dict[str, Any]]:
         all_chunks = []
-        doc = fitz.open(pdf_path)
-        base_filename = os.path.splitext(os.path.basename(pdf_path))[0]
-        logging.info(f"Memproses {len(doc)} halaman dari {os.path.basename(pdf_path)}...")
-        for page_num, page in enumerate(doc, 1):
-            raw_text = page.get_text("text")
-            is_table, reason = self._detect_table_page(raw_text, page_num)
+        with fitz.open(pdf_path) as doc:
+            base_filename = os.path.splitext(os.path.basename(pdf_path))[0]
+            logging.info(f"Memproses {len(doc)} halaman dari {os.path.basename(pdf_path)}...")
+            for page_num, page in enumerate(doc, 1):
+                raw_text = page.get_text("text", sort=False)
+                lines = self._split_lines(raw_text)
+                is_table, reason = self._detect_table_page(raw_text, page_num, lines)
             
-            content_type = "table" if is_table else "text"
-            image_path = None
-            if is_table:
-                image_path = self._save_page_screenshot(page, base_filename, page_num)
-
-            chunk = {
-                "page_number": page_num,
-                "content": self._clean_text_for_rag(raw_text),
-                "metadata": {
-                    "type": content_type,
-                    "image_path": image_path,
-                    "detection_reason": reason,
-                    "is_excluded": reason == "excluded_page"
+                content_type = "table" if is_table else "text"
+                image_path = None
+                if is_table:
+                    image_path = self._save_page_screenshot(page, base_filename, page_num, raw_text)
+
+                chunk = {
+                    "page_number": page_num,
+                    "content": self._clean_text_for_rag(raw_text, lines),
+                    "metadata": {
+                        "type": content_type,
+                        "image_path": image_path,
+                        "detection_reason": reason,
+                        "is_excluded": reason == "excluded_page"
+                    }
                 }
-            }
-            all_chunks.append(chunk)
-        doc.close()
+                all_chunks.append(chunk)
         return all_chunks
 
 
+def _file_sha256(path: str) -> str:
+    """Hash SHA-256 file secara streaming agar PDF besar tidak dibaca utuh ke memori."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+# Jumlah chunk yang dikumpulkan sebelum di-embed (batch) dan di-commit sekaligus
+CHUNK_COMMIT_BATCH = 50
+
+# Worker tunggal untuk request embedding batch: panggilan HTTP berjalan sementara thread
+# utama lanjut menganalisis halaman berikutnya. PyMuPDF tidak thread-safe, jadi analisis
+# halaman (get_text/get_pixmap) tetap di thread pemanggil.
+_embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chunk-embed")
+
+
+def _file_fingerprint(path: str) -> Dict[str, int]:
+    """Sidik jari murah file (ukuran + mtime) tanpa membaca isinya."""
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _find_document_by_fingerprint(pdf_path: str, fingerprint: Dict[str, int]) -> PdfDocument | None:
+    """
+    Cari dokumen yang pernah diproses dari path yang sama dengan ukuran & mtime identik.
+    Jika ketemu, hash SHA-256 yang tersimpan bisa dipakai tanpa membaca ulang seluruh file
+    (kasus umum saat job chunking dijalankan ulang atas folder yang sama).
+    """
+    candidates = PdfDocument.query.filter(
+        PdfDocument.doc_metadata['source_path'].as_string() == pdf_path
+    ).all()
+    for candidate in candidates:
+        if (candidate.doc_metadata or {}).get('file_fingerprint') == fingerprint and candidate.document_hash:
+            return candidate
+    return None
+
+
+def _last_processed_page(document_id) -> int:
+    """Nomor halaman terbesar yang sudah tersimpan sebagai chunk (0 jika belum ada)."""
+    return db.session.query(func.max(DocumentChunk.page_number)) \
+        .filter(DocumentChunk.document_id == document_id).scalar() or 0
+
+
+def _embed_pending_chunks(chunks: List[DocumentChunk], embedding_service: EmbeddingService):
+    """
+    Mengisi embedding chunk-chunk baru dengan panggilan batchEmbedContents (per 100 teks),
+    sebelum disimpan. Listener before_insert akan melewati chunk yang embedding-nya sudah terisi.
+    """
+    pending = [obj for obj in chunks if obj.embedding is None and obj.chunk_content]
+    if not pending:
+        return
+
+    embeddings = embedding_service.generate_batch([obj.chunk_content for obj in pending])
+    for obj, embedding in zip(pending, embeddings):
+        if embedding is not None:
+            obj.embedding = embedding
+
+
 def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=None) -> Dict[str, Any]:
     """
     Memproses PDF dengan strategi Hybrid Chunking:
     1. Halaman Tabel/Gambar -> Disimpan utuh per halaman (agar struktur tabel tidak rusak).
     2. Halaman Teks -> Di-buffer (digabung) lalu di-chunk pakai Sliding Window (agar kalimat utuh).
     """
+    # Jalur cepat: file tidak berubah (ukuran & mtime sama) dan semua halamannya sudah diproses,
+    # jadi bisa di-skip tanpa membaca maupun mem-parse PDF sama sekali.
+    # Hasilnya diteruskan ke _process_open_pdf agar stat & query source_path tidak diulang.
+    fingerprint = known_document = None
+    try:
+        fingerprint = _file_fingerprint(pdf_path)
+        known_document = _find_document_by_fingerprint(pdf_path, fingerprint)
+        if known_document and known_document.total_pages \
+                and _last_processed_page(known_document.id) >= known_document.total_pages:
+            logging.info(f"Skipping '{os.path.basename(pdf_path)}': Sudah selesai diproses.")
+            return {"status": "skipped", "filename": os.path.basename(pdf_path),
+                    "reason": "Dokumen sudah selesai diproses."}
+    except Exception as e:
+        # Biarkan jalur normal di bawah yang menangani & melaporkan error
+        logging.warning(f"Fast skip check failed for {pdf_path}: {e}")
+        db.session.rollback()
+        fingerprint = known_document = None
+
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        logging.error(f"Gagal saat inisialisasi pra-proses untuk {pdf_path}: {e}")
+        return {"status": "error", "filename": os.path.basename(pdf_path), "reason": f"Initialization error: {str(e)}"}
+
+    # PDF cukup di-parse sekali dan selalu ditutup, apa pun jalur keluarnya
+    with doc:
+        return _process_open_pdf(doc, pdf_path, job_id, progress_callback, fingerprint, known_document)
+
+
+def _process_open_pdf(doc: fitz.Document, pdf_path: str, job_id: int = None, progress_callback=None,
+                      fingerprint: Dict[str, int] | None = None,
+                      known_document: PdfDocument | None = None) -> Dict[str, Any]:
+    """
+    Isi process_and_save_pdf untuk dokumen fitz yang sudah dibuka (ditutup oleh pemanggil).
+    'fingerprint' & 'known_document' adalah hasil cek jalur cepat; jika fingerprint None,
+    keduanya dihitung ulang di sini.
+    """
     base_filename = os.path.splitext(os.path.basename(pdf_path))[0]
     original_filename = os.path.basename(pdf_path)
 
@@ -504,26 +1123,35 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
 
     # --- 1. INISIALISASI & CEK DUPLIKASI/RESUME ---
     try:
-        file_hash = hashlib.sha256(open(pdf_path, "rb").read()).hexdigest()
-        document = PdfDocument.query.filter_by(document_hash=file_hash).first()
+        if fingerprint is None:
+            fingerprint = _file_fingerprint(pdf_path)
+            known_document = _find_document_by_fingerprint(pdf_path, fingerprint)
+        document = known_document
+        if document:
+            file_hash = document.document_hash
+        else:
+            # File baru atau berubah: baru hitung hash penuh
+            file_hash = _file_sha256(pdf_path)
+            document = PdfDocument.query.filter_by(document_hash=file_hash).first()
+            if document and (document.doc_metadata or {}).get('source_path') == pdf_path:
+                # Simpan sidik jari agar run berikutnya tidak perlu hash penuh lagi
+                document.doc_metadata = {**document.doc_metadata, 'file_fingerprint': fingerprint}
+                db.session.commit()
 
-        doc_for_pages = fitz.open(pdf_path)
-        total_pages = len(doc_for_pages)
-        doc_for_pages.close()
+        total_pages = doc.page_count
 
         if document:
-            # Cek chunk terakhir untuk resume
-            last_chunk = DocumentChunk.query.filter_by(document_id=document.id) \
-                .order_by(DocumentChunk.page_number.desc()).first()
+            # Cek halaman terakhir yang sudah tersimpan untuk resume
+            last_page = _last_processed_page(document.id)
 
-            if last_chunk:
-                if last_chunk.page_number >= total_pages:
+            if last_page:
+                if last_page >= total_pages:
                     logging.info(f"Skipping '{original_filename}': Sudah selesai diproses.")
                     return {"status": "skipped", "filename": original_filename,
                             "reason": "Dokumen sudah selesai diproses."}
 
                 # Resume dari halaman berikutnya
-                start_page = last_chunk.page_number + 1
+                start_page = last_page + 1
                 logging.info(f"Resuming '{original_filename}' from page {start_page}.")
             else:
                 start_page = 1
@@ -533,7 +1161,7 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
                 filename=original_filename,
                 total_pages=total_pages,
                 document_hash=file_hash,
-                doc_metadata={'source_path': pdf_path}
+                doc_metadata={'source_path': pdf_path, 'file_fingerprint': fingerprint}
             )
 
     except Exception as e:
@@ -541,11 +1169,51 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
         return {"status": "error", "filename": original_filename, "reason": f"Initialization error: {str(e)}"}
 
     # --- 2. MULAI PEMROSESAN UTAMA ---
+    # Dokumen baru disimpan sekali di sini agar document.id tersedia untuk semua chunk
+    # dan langsung di-commit: dokumen tanpa chunk (mis. semua halaman excluded) tetap tersimpan,
+    # dan rollback karena error di file berikutnya tidak ikut membuangnya
+    if not document.id:
+        try:
+            db.session.add(document)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Gagal menyimpan entry dokumen untuk {pdf_path}: {e}")
+            return {"status": "error", "filename": original_filename, "reason": f"Initialization error: {str(e)}"}
+
     detector = RobustTableDetector()
-    doc = fitz.open(pdf_path)
+    embedding_service = EmbeddingService()
+
+    # Chunk yang belum disimpan. Sengaja belum di-add ke session agar commit lain
+    # (mis. heartbeat job di progress_callback) tidak ikut meng-insert-nya satu per satu.
+    pending_chunks: List[DocumentChunk] = []
+    # Batch yang embedding-nya sedang dibuat di _embedding_executor: (chunks, future)
+    in_flight = None
+
+    def commit_pending_chunks(wait: bool = False):
+        """
+        Simpan batch sebelumnya (setelah embedding-nya selesai), lalu kirim batch saat ini
+        ke worker embedding. Dengan wait=True, batch saat ini juga ditunggu dan disimpan.
+        """
+        nonlocal in_flight
+        if in_flight:
+            chunks, future = in_flight
+            in_flight = None
+            future.result()
+            db.session.add_all(chunks)
+            db.session.commit()
+
+        if pending_chunks:
+            batch = list(pending_chunks)
+            pending_chunks.clear()
+            in_flight = (batch, _embedding_executor.submit(_embed_pending_chunks, batch, embedding_service))
+            if wait:
+                commit_pending_chunks()
 
     # Buffer teks untuk context windowing (FIX FATAL #2)
-    text_buffer = ""
+    # Disimpan sebagai list potongan teks (digabung saat flush) agar akumulasi tetap linear
+    buffer_parts: List[str] = []
+    buffer_len = 0
     # Menandai dari halaman mana buffer ini dimulai (untuk metadata aproksimasi)
     buffer_start_page = start_page
 
@@ -556,7 +1224,8 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
         try:
             # Cek interupsi job (tombol stop)
             if job_id and check_job_should_stop(job_id):
-                doc.close()
+                # Simpan chunk yang sudah jadi agar resume mulai dari halaman ini
+                commit_pending_chunks(wait=True)
                 logging.info(f"Proses dihentikan oleh pengguna sebelum halaman {page_num}.")
                 return {"status": "stopped", "filename": original_filename,
                         "reason": f"Dihentikan oleh pengguna pada halaman {page_num}"}
@@ -565,17 +1234,16 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
                 progress_callback(message=f"Menganalisis Halaman {page_num}/{total_pages} (File: {original_filename})")
 
             # Ekstrak Teks & Deteksi Tabel
-            raw_text = page.get_text("text")
-            is_table, reason = detector._detect_table_page(raw_text, page_num)
+            # Teks diekstrak & dipecah per baris sekali, lalu dipakai bersama detektor dan cleaner
+            raw_text = page.get_text("text", sort=False)
+            lines = detector._split_lines(raw_text)
+            # Digest dihitung sekali per halaman: untuk memo deteksi dan dedup screenshot
+            text_digest = detector._text_digest(raw_text)
+            is_table, reason = detector._detect_table_page(raw_text, page_num, lines, text_digest)
 
             if reason == "excluded_page":
                 continue
 
-            # Pastikan dokumen tersimpan di DB sebelum insert chunk
-            if not document.id:
-                db.session.add(document)
-                db.session.flush()
-
             # --- LOGIKA HYBRID CHUNKING ---
 
             # KONDISI A: HALAMAN TABEL / GAMBAR PENUH
@@ -583,8 +1251,8 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
             if is_table or reason == "image_only_page":
 
                 # 1. Simpan sisa buffer teks (jika ada) sebelum masuk ke tabel
-                if text_buffer:
-                    text_chunks = semantic_sliding_window_chunker(text_buffer)
+                if buffer_parts:
+                    text_chunks = semantic_sliding_window_chunker(" ".join(buffer_parts))
                     for txt_content in text_chunks:
                         chunk_obj = DocumentChunk(
                             document_id=document.id,
@@ -592,18 +1260,19 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
                             chunk_content=txt_content,
                             chunk_metadata={"type": "text", "source": "buffered_text"}
                         )
-                        db.session.add(chunk_obj)
+                        pending_chunks.append(chunk_obj)
 
-                    text_buffer = ""  # Reset buffer
+                    buffer_parts = []  # Reset buffer
+                    buffer_len = 0
 
                 # 2. Simpan Halaman Tabel ini secara UTUH (jangan dipotong sliding window)
                 # Agar struktur tabel/gambar tetap terjaga dan bisa direkonstruksi nanti
-                image_path = detector._save_page_screenshot(page, base_filename, page_num)
+                image_path = detector._save_page_screenshot(page, base_filename, page_num, raw_text, text_digest)
 
                 table_chunk = DocumentChunk(
                     document_id=document.id,
                     page_number=page_num,
-                    chunk_content=detector._clean_text_for_rag(raw_text),
+                    chunk_content=detector._clean_text_for_rag(raw_text, lines),
                     chunk_metadata={
                         "type": "table" if is_table else "image",
                         "image_path": image_path,
@@ -611,8 +1280,9 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
                         "is_excluded": False
                     }
                 )
-                db.session.add(table_chunk)
-                db.session.commit()  # Commit tabel langsung
+                pending_chunks.append(table_chunk)
+                if len(pending_chunks) >= CHUNK_COMMIT_BATCH:
+                    commit_pending_chunks()
 
                 # Reset penanda buffer untuk halaman teks berikutnya
                 buffer_start_page = page_num + 1
@@ -620,13 +1290,14 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
 
                 # KONDISI B: HALAMAN TEKS BIASA
             # Jangan simpan dulu! Masukkan ke buffer agar kalimat di akhir halaman bisa nyambung.
-            cleaned_text = detector._clean_text_for_rag(raw_text)
-            text_buffer += " " + cleaned_text
+            cleaned_text = detector._clean_text_for_rag(raw_text, lines)
+            buffer_parts.append(cleaned_text)
+            buffer_len += len(cleaned_text) + 1
 
             # Optimasi: Jika buffer sudah terlalu besar (misal > 3 halaman / 5000 chars),
             # kita proses sebagian untuk menghemat memori, tapi sisakan ujungnya untuk overlap.
-            if len(text_buffer) > 5000:
-                text_chunks = semantic_sliding_window_chunker(text_buffer)
+            if buffer_len > 5000:
+                text_chunks = semantic_sliding_window_chunker(" ".join(buffer_parts))
 
                 # Ambil chunk terakhir untuk dimasukkan kembali ke buffer (agar overlap terjaga)
                 if text_chunks:
@@ -639,22 +1310,23 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
                             chunk_content=txt_content,
                             chunk_metadata={"type": "text"}
                         )
-                        db.session.add(chunk_obj)
+                        pending_chunks.append(chunk_obj)
 
                     # Sisanya kembalikan ke buffer
-                    text_buffer = last_chunk_to_keep
-                    db.session.commit()  # Commit partial
+                    buffer_parts = [last_chunk_to_keep]
+                    buffer_len = len(last_chunk_to_keep)
+                    if len(pending_chunks) >= CHUNK_COMMIT_BATCH:
+                        commit_pending_chunks()
 
         except Exception as e:
             db.session.rollback()
-            doc.close()
             logging.error(f"Gagal memproses halaman {page_num} dari '{pdf_path}': {e}")
             return {"status": "error", "filename": original_filename, "reason": f"Error on page {page_num}: {str(e)}"}
 
     # --- 3. FLUSH BUFFER TERAKHIR (SANGAT PENTING) ---
     # Setelah loop selesai, kemungkinan masih ada teks tersisa di buffer
-    if text_buffer:
-        text_chunks = semantic_sliding_window_chunker(text_buffer)
+    if buffer_parts:
+        text_chunks = semantic_sliding_window_chunker(" ".join(buffer_parts))
         for txt_content in text_chunks:
             chunk_obj = DocumentChunk(
                 document_id=document.id,
@@ -662,11 +1334,11 @@ def process_and_save_pdf(pdf_path: str, job_id: int = None, progress_callback=No
                 chunk_content=txt_content,
                 chunk_metadata={"type": "text", "source": "final_buffer"}
             )
-            db.session.add(chunk_obj)
-        db.session.commit()
+            pending_chunks.append(chunk_obj)
+    commit_pending_chunks(wait=True)
 
-    doc.close()
-    return {"status": "success", "filename": original_filename, "pages_chunked": total_pages - start_page + 1}
+    return {"status": "success", "filename": original_filename, "pages_chunked": total_pages - start_page + 1,
+            "document_id": str(document.id)}
 
 
 def semantic_sliding_window_chunker(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
@@ -678,7 +1350,10 @@ def semantic_sliding_window_chunker(text: str, chunk_size: int = 1000, overlap:
         return []
 
     # Bersihkan multiple spasi/newline berlebih
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = _WS_RE.sub(' ', text).strip()
+
+    # Posisi semua akhir kalimat dihitung sekali, lalu dicari dengan bisect per chunk
+    sentence_ends = [m.start() for m in _SENT_END_RE.finditer(text)]
 
     chunks = []
     start = 0
@@ -692,13 +1367,10 @@ def semantic_sliding_window_chunker(text: str, chunk_size: int = 1000, overlap:
             chunks.append(text[start:])
             break
 
-        # Cari titik pemisah yang baik (titik, tanda tanya, seru) MUNDUR dari posisi 'end'
-        last_period = text.rfind('.', start, end)
-        last_question = text.rfind('?', start, end)
-        last_exclamation = text.rfind('!', start, end)
-
-        # Ambil posisi tanda baca terjauh (paling mendekati akhir chunk)
-        split_point = max(last_period, last_question, last_exclamation)
+        # Cari titik pemisah yang baik (titik, tanda tanya, seru) MUNDUR dari posisi 'end':
+        # akhir kalimat terjauh yang masih berada di [start, end)
+        idx = bisect.bisect_left(sentence_ends, end) - 1
+        split_point = sentence_ends[idx] if idx >= 0 and sentence_ends[idx] >= start else -1
 
         # Aturan pemotongan:
         # Split point harus valid (!=-1) DAN
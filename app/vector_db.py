@@ -2,7 +2,10 @@
 import chromadb
 from chromadb.config import Settings
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from .models import BeritaBps, DocumentChunk
 import logging
 import numpy as np
@@ -13,26 +16,41 @@ import numpy as np
 
 IS_PRODUCTION = os.getenv('ENVIRONMENT') == 'production'
 
-if IS_PRODUCTION:
-    # Production: Gunakan HttpClient
-    CHROMA_HOST = os.getenv('CHROMA_HOST', 'localhost')
-    CHROMA_PORT = int(os.getenv('CHROMA_PORT', 8000))
-    
-    client = chromadb.HttpClient(
-        host=CHROMA_HOST,
-        port=CHROMA_PORT,
-        settings=Settings(anonymized_telemetry=False)
-    )
-    print(f"🌐 ChromaDB: Connected to service at {CHROMA_HOST}:{CHROMA_PORT}")
-else:
-    # Local Development: Gunakan PersistentClient
-    client = chromadb.PersistentClient(path="chroma_data/")
-    print("💻 ChromaDB: Running in embedded mode (local)")
+# Client & collections dibuat saat pertama kali dibutuhkan (bukan saat import), agar startup
+# Flask tidak menunggu handshake ChromaDB. Lock menjaga inisialisasi hanya terjadi sekali
+# walaupun beberapa thread request memanggilnya bersamaan.
+_client = None
+_init_lock = threading.Lock()
 
 # Buat atau ambil collections
 berita_collection = None
 document_collection = None
 
+def get_client():
+    """Client ChromaDB (HttpClient di production, PersistentClient di lokal), dibuat sekali."""
+    global _client
+
+    if _client is None:
+        with _init_lock:
+            if _client is None:
+                if IS_PRODUCTION:
+                    # Production: Gunakan HttpClient
+                    chroma_host = os.getenv('CHROMA_HOST', 'localhost')
+                    chroma_port = int(os.getenv('CHROMA_PORT', 8000))
+
+                    _client = chromadb.HttpClient(
+                        host=chroma_host,
+                        port=chroma_port,
+                        settings=Settings(anonymized_telemetry=False)
+                    )
+                    print(f"🌐 ChromaDB: Connected to service at {chroma_host}:{chroma_port}")
+                else:
+                    # Local Development: Gunakan PersistentClient
+                    _client = chromadb.PersistentClient(path="chroma_data/")
+                    print("💻 ChromaDB: Running in embedded mode (local)")
+
+    return _client
+
 def get_collections():
     """
     Lazy initialization untuk collections.
@@ -41,19 +59,22 @@ def get_collections():
     global berita_collection, document_collection
     
     if berita_collection is None or document_collection is None:
-        try:
-            berita_collection = client.get_or_create_collection(
-                name="berita_bps",
-                metadata={"hnsw:space": "cosine"}
-            )
-            document_collection = client.get_or_create_collection(
-                name="document_chunks",
-                metadata={"hnsw:space": "cosine"}
-            )
-            logging.info("ChromaDB collections initialized successfully")
-        except Exception as e:
-            logging.error(f"Failed to initialize ChromaDB collections: {e}")
-            raise
+        client = get_client()
+        with _init_lock:
+            if berita_collection is None or document_collection is None:
+                try:
+                    berita_collection = client.get_or_create_collection(
+                        name="berita_bps",
+                        metadata={"hnsw:space": "cosine"}
+                    )
+                    document_collection = client.get_or_create_collection(
+                        name="document_chunks",
+                        metadata={"hnsw:space": "cosine"}
+                    )
+                    logging.info("ChromaDB collections initialized successfully")
+                except Exception as e:
+                    logging.error(f"Failed to initialize ChromaDB collections: {e}")
+                    raise
     
     return berita_collection, document_collection
 
@@ -61,79 +82,165 @@ def get_collections():
 # ==========================================
 # LISTENER FROM POSTGRES TO CHROMADB
 # ==========================================
+# Listener mapper hanya mencatat perubahan di session.info; sinkronisasi ke ChromaDB
+# dilakukan sekali per commit (satu upsert/delete per koleksi), bukan satu request per baris.
+# Perubahan dari transaksi yang di-rollback tidak pernah dikirim ke ChromaDB.
+
+_PENDING_KEY = 'pending_chroma_sync'
+# Worker tunggal pengirim perubahan ke ChromaDB (FIFO). Urutan hanya terjaga antar perubahan
+# yang diantrikan lewat modul ini (listener dan queue_document_vectors_delete); penulisan
+# langsung ke koleksi harus didahului wait_for_chroma_sync().
+_chroma_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-sync")
+# Jumlah item maksimum per panggilan upsert ke ChromaDB
+CHROMA_UPSERT_BATCH = 1000
+
+
+def _pending_for(target, collection_name: str) -> dict | None:
+    """Antrian sinkronisasi (upserts & deletes) untuk koleksi di session milik 'target'."""
+    session = object_session(target)
+    if session is None:
+        return None
+    pending = session.info.setdefault(_PENDING_KEY, {})
+    return pending.setdefault(collection_name, {'upserts': {}, 'deletes': set()})
+
+
+def _queue_upsert(target, collection_name: str, metadata: dict):
+    pending = _pending_for(target, collection_name)
+    if pending is None:
+        return
+    target_id = str(target.id)
+    # Chroma menerima ndarray float32 langsung; vektor hasil load pgvector sudah float32 sehingga
+    # tidak disalin, dan list dari EmbeddingService dikemas tanpa membuat list Python baru
+    embedding = np.asarray(target.embedding, dtype=np.float32)
+    pending['deletes'].discard(target_id)
+    pending['upserts'][target_id] = (embedding, metadata)
+
+
+def _queue_delete(target, collection_name: str):
+    pending = _pending_for(target, collection_name)
+    if pending is None:
+        return
+    target_id = str(target.id)
+    pending['upserts'].pop(target_id, None)
+    pending['deletes'].add(target_id)
+
+
+def berita_metadata(news: BeritaBps) -> dict:
+    """Metadata ChromaDB untuk satu BeritaBps (dipakai listener dan script reindex)."""
+    return {
+        "judul": news.judul_berita,
+        "tanggal_rilis": str(news.tanggal_rilis),
+        "year": int(news.tanggal_rilis.year)  # <--- TAMBAHKAN INI (Integer)
+    }
+
+def build_berita_payload(news: BeritaBps) -> tuple:
+    """(id, embedding float32, metadata) untuk upsert BeritaBps ke ChromaDB secara batch."""
+    return str(news.id), np.asarray(news.embedding, dtype=np.float32), berita_metadata(news)
 
 def sync_berita_to_chroma(mapper, connection, target):
     """
     Fungsi ini akan dijalankan setelah insert atau update pada BeritaBps.
     'target' adalah instance dari BeritaBps yang baru saja disimpan.
     """
-    logging.info(f"Listener 'sync_berita_to_chroma' terpicu untuk ID: {target.id}")
     if target.embedding is None:
         logging.warning(f"Embedding untuk BeritaBps ID {target.id} kosong, skip sinkronisasi ke Chroma.")
         return
 
-    try:
-        berita_col, _ = get_collections()
-        embedding_list = target.embedding.tolist() if isinstance(target.embedding, np.ndarray) else target.embedding
-
-        berita_col.upsert(
-            ids=[str(target.id)],
-            embeddings=[embedding_list],
-            metadatas=[{
-                "judul": target.judul_berita,
-                "tanggal_rilis": str(target.tanggal_rilis),
-                "year": int(target.tanggal_rilis.year)  # <--- TAMBAHKAN INI (Integer)
-            }]
-        )
-        logging.info(f"Berhasil upsert BeritaBps ID {target.id} ke ChromaDB.")
-    except Exception as e:
-        logging.error(f"Gagal sinkronisasi BeritaBps ID {target.id} ke ChromaDB: {e}")
+    _queue_upsert(target, 'berita', berita_metadata(target))
 
 def sync_chunk_to_chroma(mapper, connection, target):
     """
     Fungsi ini akan dijalankan setelah insert atau update pada DocumentChunk.
     'target' adalah instance dari DocumentChunk yang baru saja disimpan.
     """
-    logging.info(f"Listener 'sync_chunk_to_chroma' terpicu untuk ID: {target.id}")
     if target.embedding is None:
         logging.warning(f"Embedding untuk DocumentChunk ID {target.id} kosong, skip sinkronisasi ke Chroma.")
         return
 
-    try:
-        _, document_col = get_collections()
-
-        embedding_list = target.embedding.tolist() if isinstance(target.embedding, np.ndarray) else target.embedding
-
-        document_col.upsert(
-            ids=[str(target.id)],
-            embeddings=[embedding_list],
-            metadatas=[
-                {"document_id": str(target.document_id), "page_number": target.page_number}
-            ]
-        )
-        logging.info(f"Berhasil upsert DocumentChunk ID {target.id} ke ChromaDB.")
-    except Exception as e:
-        logging.error(f"Gagal sinkronisasi DocumentChunk ID {target.id} ke ChromaDB: {e}")
+    _queue_upsert(target, 'chunk', {"document_id": str(target.document_id), "page_number": target.page_number})
 
 def delete_berita_from_chroma(mapper, connection, target):
     """ Dijalankan setelah data BeritaBps dihapus dari PostgreSQL. """
-    logging.info(f"Listener 'delete_berita_from_chroma' terpicu untuk ID: {target.id}")
-    try:
-        berita_col, _ = get_collections()
-        berita_col.delete(ids=[str(target.id)])
-        logging.info(f"Berhasil delete BeritaBps ID {target.id} dari ChromaDB.")
-    except Exception as e:
-        logging.error(f"Gagal delete BeritaBps ID {target.id} dari ChromaDB: {e}")
+    _queue_delete(target, 'berita')
 
 def delete_chunk_from_chroma(mapper, connection, target):
     """ Dijalankan setelah data DocumentChunk dihapus dari PostgreSQL. """
-    logging.info(f"Listener 'delete_chunk_from_chroma' terpicu untuk ID: {target.id}")
+    _queue_delete(target, 'chunk')
+
+
+def flush_pending_chroma_sync(session):
+    """
+    Dijalankan setelah commit: kirim semua perubahan yang tertunda ke ChromaDB secara batch.
+    Pengiriman dilakukan di thread _chroma_sync_executor agar pemanggil (mis. ingest PDF)
+    tidak menunggu request ChromaDB; satu worker mengirim batch sesuai urutan commit.
+    """
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    _chroma_sync_executor.submit(_send_pending_to_chroma, pending)
+
+
+def queue_document_vectors_delete(document_id):
+    """
+    Antrikan penghapusan semua vector milik satu dokumen (filter metadata document_id) di
+    executor yang sama dengan upsert listener, sehingga upsert chunk yang masih antre
+    (mis. upload lalu langsung hapus) dikirim lebih dulu dan tidak menyisakan vector yatim.
+    """
+    _chroma_sync_executor.submit(_delete_document_vectors, str(document_id))
+
+
+def _delete_document_vectors(document_id: str):
     try:
         _, document_col = get_collections()
-        document_col.delete(ids=[str(target.id)])
-        logging.info(f"Berhasil delete DocumentChunk ID {target.id} dari ChromaDB.")
+        document_col.delete(where={"document_id": document_id})
+        logging.info(f"Berhasil menghapus vector dokumen {document_id} dari ChromaDB.")
     except Exception as e:
-        logging.error(f"Gagal delete DocumentChunk ID {target.id} dari ChromaDB: {e}")
+        logging.error(f"Gagal menghapus vector dokumen {document_id} dari ChromaDB: {e}")
+
+
+def wait_for_chroma_sync():
+    """
+    Tunggu semua sinkronisasi ChromaDB yang sudah diantrikan selesai. Wajib dipanggil di akhir
+    proses anak multiprocessing, yang keluar tanpa menunggu thread executor.
+    """
+    _chroma_sync_executor.submit(lambda: None).result()
+
+
+def _send_pending_to_chroma(pending: dict):
+    """Satu upsert (per CHROMA_UPSERT_BATCH) dan satu delete per koleksi untuk satu commit."""
+    try:
+        berita_col, document_col = get_collections()
+    except Exception as e:
+        logging.error(f"Gagal sinkronisasi ke ChromaDB: {e}")
+        return
+
+    collections = {'berita': berita_col, 'chunk': document_col}
+    for collection_name, changes in pending.items():
+        collection = collections[collection_name]
+        upserts = list(changes['upserts'].items())
+        for start in range(0, len(upserts), CHROMA_UPSERT_BATCH):
+            batch = upserts[start:start + CHROMA_UPSERT_BATCH]
+            try:
+                collection.upsert(
+                    ids=[target_id for target_id, _ in batch],
+                    embeddings=[embedding for _, (embedding, _) in batch],
+                    metadatas=[metadata for _, (_, metadata) in batch]
+                )
+                logging.info(f"Berhasil upsert {len(batch)} item ke koleksi ChromaDB '{collection.name}'.")
+            except Exception as e:
+                logging.error(f"Gagal upsert {len(batch)} item ke koleksi ChromaDB '{collection.name}': {e}")
+
+        if changes['deletes']:
+            try:
+                collection.delete(ids=list(changes['deletes']))
+                logging.info(f"Berhasil delete {len(changes['deletes'])} item dari koleksi ChromaDB '{collection.name}'.")
+            except Exception as e:
+                logging.error(f"Gagal delete item dari koleksi ChromaDB '{collection.name}': {e}")
+
+
+def discard_pending_chroma_sync(session):
+    """Dijalankan setelah rollback: buang perubahan yang tidak jadi tersimpan di PostgreSQL."""
+    session.info.pop(_PENDING_KEY, None)
 
 
 def register_db_listeners():
@@ -147,5 +254,9 @@ def register_db_listeners():
     event.listen(DocumentChunk, 'after_insert', sync_chunk_to_chroma)
     event.listen(DocumentChunk, 'after_update', sync_chunk_to_chroma)
     event.listen(DocumentChunk, 'after_delete', delete_chunk_from_chroma)
+
+    # Pengiriman batch ke ChromaDB per transaksi
+    event.listen(Session, 'after_commit', flush_pending_chroma_sync)
+    event.listen(Session, 'after_rollback', discard_pending_chroma_sync)
     
-    logging.info("Database listeners untuk sinkronisasi ChromaDB berhasil didaftarkan.")
\ No newline at end of file
+    logging.info("Database listeners untuk sinkronisasi ChromaDB berhasil didaftarkan.")
@@ -1,8 +1,11 @@
+import argparse
 import logging
-import time
+import numpy as np
 from app import create_app, db
 from app.models import BeritaBps
-from app.vector_db import sync_berita_to_chroma, get_collections
+from app.services import EmbeddingService
+from sqlalchemy import func, update
+from app.vector_db import berita_metadata, build_berita_payload, get_collections, CHROMA_UPSERT_BATCH
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -10,8 +13,53 @@ logger = logging.getLogger(__name__)
 
 app = create_app()
 
+# Jumlah baris yang diambil dari PostgreSQL per round-trip
+STREAM_BATCH = 500
 
-def reindex_all_berita():
+
+def _upsert_batch(berita_col, payloads):
+    """Satu panggilan upsert ChromaDB untuk sekumpulan (id, embedding, metadata)."""
+    berita_col.upsert(
+        ids=[item_id for item_id, _, _ in payloads],
+        embeddings=[embedding for _, embedding, _ in payloads],
+        metadatas=[metadata for _, _, metadata in payloads]
+    )
+
+
+def _embed_missing(berita_col, missing_ids, batch_size):
+    """
+    Buat embedding untuk berita yang belum punya, per 'batch_size' teks lewat generate_batch
+    (batchEmbedContents), simpan ke PostgreSQL, lalu upsert ke ChromaDB. Mengembalikan jumlah
+    berita yang berhasil disinkronkan.
+    """
+    embedding_service = EmbeddingService()
+    synced = 0
+    for start in range(0, len(missing_ids), batch_size):
+        batch = BeritaBps.query.filter(BeritaBps.id.in_(missing_ids[start:start + batch_size])).all()
+        embeddings = embedding_service.generate_batch([news.embedding_text() for news in batch])
+        embedded = [(news, embedding) for news, embedding in zip(batch, embeddings) if embedding is not None]
+        if not embedded:
+            continue
+
+        # Bulk UPDATE by primary key: tidak memicu listener per baris (upsert dilakukan di bawah)
+        db.session.execute(update(BeritaBps), [{"id": news.id, "embedding": embedding} for news, embedding in embedded])
+        db.session.commit()
+
+        try:
+            # Objek di session tidak ikut di-refresh oleh bulk UPDATE, jadi pakai embedding yang baru dibuat
+            _upsert_batch(berita_col, [
+                (str(news.id), np.asarray(embedding, dtype=np.float32), berita_metadata(news))
+                for news, embedding in embedded
+            ])
+            synced += len(embedded)
+        except Exception as e:
+            logger.error(f"Gagal sync batch berita baru ter-embed: {e}")
+        db.session.expunge_all()
+        logger.info(f"Embedding dibuat untuk {len(embedded)}/{len(batch)} berita tanpa embedding.")
+    return synced
+
+
+def reindex_all_berita(batch_size: int = CHROMA_UPSERT_BATCH, limit: int | None = None):
     """
     Memaksa update semua data BeritaBps ke ChromaDB agar metadata 'year' masuk.
     """
@@ -20,30 +68,65 @@ def reindex_all_berita():
 
         # 1. Pastikan koneksi DB siap
         try:
-            get_collections()
+            berita_col, _ = get_collections()
         except Exception as e:
             logger.error(f"Gagal konek ChromaDB: {e}")
             return
 
-        # 2. Ambil semua berita
-        all_news = BeritaBps.query.all()
-        total = len(all_news)
+        # 2. Hitung & stream berita per 500 baris (tidak memuat seluruh tabel ke memori)
+        total = db.session.query(func.count(BeritaBps.id)).scalar()
+        if limit is not None:
+            total = min(total, limit)
         logger.info(f"Ditemukan {total} berita untuk disinkronisasi ulang.")
+        all_news = BeritaBps.query.order_by(BeritaBps.id).limit(limit) \
+            .execution_options(stream_results=True).yield_per(STREAM_BATCH)
 
-        for i, news in enumerate(all_news, 1):
+        # 3. Upsert per batch (satu request ChromaDB per 'batch_size' berita),
+        #    menimpa data lama dengan data baru yang ada 'year'-nya
+        payloads = []
+        synced = 0
+        # ID berita yang belum punya embedding; di-embed per batch setelah stream selesai
+        missing_ids = []
+
+        def flush(processed):
+            nonlocal payloads, synced
             try:
-                # Panggil fungsi sync yang sudah kita update tadi
-                # Fungsi ini akan menimpa data lama dengan data baru yang ada 'year'-nya
-                sync_berita_to_chroma(None, None, news)
+                _upsert_batch(berita_col, payloads)
+                synced += len(payloads)
+            except Exception as e:
+                logger.error(f"Gagal sync batch berita (ID {payloads[0][0]}-{payloads[-1][0]}): {e}")
+            payloads = []
+            logger.info(f"Progress: {processed}/{total} berita diproses...")
 
-                if i % 10 == 0:
-                    logger.info(f"Progress: {i}/{total} berita diproses...")
+        i = 0
+        for i, news in enumerate(all_news, 1):
+            if news.embedding is None:
+                missing_ids.append(news.id)
+            else:
+                payloads.append(build_berita_payload(news))
 
-            except Exception as e:
-                logger.error(f"Gagal sync berita ID {news.id}: {e}")
+            if len(payloads) >= batch_size:
+                flush(i)
+            if i % STREAM_BATCH == 0:
+                # Lepas objek yang sudah diproses dari identity map agar memori tetap O(batch)
+                db.session.expunge_all()
+
+        if payloads:
+            flush(i)
+
+        # 4. Berita tanpa embedding: embed per batch, bukan satu request per berita
+        if missing_ids:
+            logger.info(f"{len(missing_ids)} berita belum punya embedding, membuat embedding secara batch...")
+            synced += _embed_missing(berita_col, missing_ids, batch_size)
 
-        logger.info("=== RE-SYNC BERITA SELESAI ===")
+        logger.info(f"=== RE-SYNC BERITA SELESAI ({synced} berita tersinkronisasi) ===")
 
 
 if __name__ == "__main__":
-    reindex_all_berita()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sinkronisasi ulang semua BeritaBps ke ChromaDB.")
+    parser.add_argument('--batch-size', type=int, default=CHROMA_UPSERT_BATCH,
+                        help=f"Jumlah berita per request upsert ChromaDB (default: {CHROMA_UPSERT_BATCH}).")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="Proses paling banyak N berita (untuk uji coba).")
+    args = parser.parse_args()
+    reindex_all_berita(batch_size=args.batch_size, limit=args.limit)
\ No newline at end of file
@@ -1,10 +1,15 @@
 import os
 import logging
-import time
-import sys  # Tambahkan sys untuk membaca argumen terminal
+import multiprocessing
+import uuid
+import argparse
+from datetime import datetime
+import pytz
 from app import create_app, db
 from app.models import PdfDocument, DocumentChunk
-from app.vector_db import get_collections
+from sqlalchemy import select, text
+from app.vector_db import get_collections, wait_for_chroma_sync, IS_PRODUCTION
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,14 +17,82 @@ logger = logging.getLogger(__name__)
 
 app = create_app()
 
+# Jumlah document_id per filter '$in' (ChromaDB) / IN (...) (SQL) saat menghapus data lama
+DELETE_BATCH = 500
+# Penanda di doc_metadata bahwa dokumen sudah selesai di-reindex (untuk resume setelah crash)
+REINDEXED_AT_KEY = 'reindexed_at'
+# Batas proporsi file PDF yang hilang; di atas ini reindex dibatalkan sebelum ada data yang dihapus
+MAX_MISSING_RATIO = 0.05
 
-def reindex_all_documents():
+
+def _default_worker_count() -> int:
+    """
+    Jumlah proses worker: REINDEX_WORKERS jika di-set. Tanpa itu, semua core di production
+    (ChromaDB lewat HttpClient), dan 1 di lokal karena PersistentClient (SQLite embedded)
+    tidak aman ditulis dari beberapa proses sekaligus.
+    """
+    configured = os.getenv('REINDEX_WORKERS')
+    if configured:
+        return max(1, int(configured))
+    return (os.cpu_count() or 1) if IS_PRODUCTION else 1
+
+
+def _reprocess_file(file_path: str) -> dict:
+    """Dijalankan di proses worker: proses ulang satu PDF dalam app context proses tersebut."""
+    with app.app_context():
+        from app.services import process_and_save_pdf
+        result = process_and_save_pdf(file_path)
+        # Proses anak keluar tanpa menunggu thread sinkronisasi ChromaDB
+        wait_for_chroma_sync()
+        return result
+
+
+def _existing_files(file_paths: list) -> set:
+    """
+    Path (dari 'file_paths') yang file-nya ada. Tiap folder cukup dibaca sekali dengan
+    os.scandir, bukan satu stat per dokumen (mahal di storage jaringan).
+    """
+    by_dir = {}
+    for file_path in file_paths:
+        by_dir.setdefault(os.path.dirname(file_path), set()).add(os.path.basename(file_path))
+
+    existing = set()
+    for directory, names in by_dir.items():
+        try:
+            with os.scandir(directory or '.') as entries:
+                found = {entry.name for entry in entries if entry.name in names and entry.is_file()}
+        except OSError:
+            continue
+        existing.update(os.path.join(directory, name) for name in found)
+    return existing
+
+
+def _mark_reindexed(original_id, result: dict):
+    """
+    Tandai dokumen selesai di-reindex. Jika process_and_save_pdf membuat baris baru (isi file
+    berubah sehingga hash berbeda), baris lama yang chunk-nya sudah dihapus ikut dibuang.
+    """
+    new_id = uuid.UUID(result['document_id']) if result.get('document_id') else original_id
+    if new_id != original_id:
+        PdfDocument.query.filter_by(id=original_id).delete()
+    document = db.session.get(PdfDocument, new_id)
+    if document:
+        document.doc_metadata = {**(document.doc_metadata or {}),
+                                 REINDEXED_AT_KEY: datetime.now(pytz.utc).isoformat()}
+    db.session.commit()
+
+
+def reindex_all_documents(workers: int | None = None, force: bool = False, limit: int | None = None,
+                          delete_batch: int = DELETE_BATCH, allow_missing: bool = False):
     """
     Fungsi ini akan:
-    1. Mengambil list semua dokumen PDF yang ada di DB.
+    1. Mengambil list dokumen PDF di DB yang belum di-reindex (semua jika force=True), lalu
+       membatalkan proses jika file fisik yang hilang melebihi MAX_MISSING_RATIO
+       (kecuali allow_missing=True), sebelum ada data yang diubah.
     2. Menghapus embedding lama di ChromaDB.
-    3. Menghapus chunk lama di Postgres.
-    4. Menjalankan ulang process_and_save_pdf.
+    3. Menghapus chunk lama di Postgres (baris dokumen tetap ada sebagai checkpoint).
+    4. Menjalankan ulang process_and_save_pdf, paralel per dokumen (lihat _default_worker_count),
+       lalu menandai dokumen dengan 'reindexed_at' sehingga run berikutnya bisa resume.
     """
     with app.app_context():
         # --- PERBAIKAN 1: Pindahkan Import ke SINI ---
@@ -29,8 +102,13 @@ def reindex_all_documents():
 
         logger.info("=== MEMULAI PROSES RE-INDEXING DOKUMEN ===")
 
-        # 1. Ambil semua dokumen
-        all_docs = PdfDocument.query.all()
+        reindexed_at = PdfDocument.doc_metadata[REINDEXED_AT_KEY].as_string()
+
+        # 1. Ambil dokumen yang belum di-reindex (hanya kolom yang dibutuhkan, tanpa objek ORM)
+        query = select(PdfDocument.id, PdfDocument.filename, PdfDocument.doc_metadata)
+        if not force:
+            query = query.where(reindexed_at.is_(None))
+        all_docs = db.session.execute(query.limit(limit)).all()
 
         if not all_docs:
             logger.info("Tidak ada dokumen yang perlu diproses.")
@@ -39,68 +117,134 @@ def reindex_all_documents():
         total_docs = len(all_docs)
         logger.info(f"Ditemukan {total_docs} dokumen untuk diproses ulang.")
 
-        # Ambil collection
-        try:
-            _, doc_collection = get_collections()
-            logger.info("Berhasil terhubung ke ChromaDB Collection.")
-        except Exception as e:
-            logger.error(f"Gagal koneksi ke ChromaDB: {e}")
-            return
-
-        for index, doc in enumerate(all_docs, 1):
-            file_path = doc.doc_metadata.get('source_path')
+        # 2. Preflight: cek semua file fisik sebelum ada data yang dihapus
+        file_paths = []
+        for doc in all_docs:
+            file_path = (doc.doc_metadata or {}).get('source_path')
             # Fallback path
             if not file_path:
                 file_path = os.path.join(app.config.get('UPLOAD_FOLDER', 'uploads'), doc.filename)
+            file_paths.append(file_path)
+        existing_files = _existing_files(file_paths)
 
-            original_filename = doc.filename
-            doc_id = doc.id
-
-            logger.info(f"[{index}/{total_docs}] Memproses: {original_filename} (ID: {doc_id})")
-
+        to_process = []
+        doc_ids = []
+        for index, (doc, file_path) in enumerate(zip(all_docs, file_paths), 1):
             # Cek fisik file
-            if not os.path.exists(file_path):
-                logger.error(f"   [SKIP] File fisik tidak ditemukan di: {file_path}")
+            if file_path not in existing_files:
+                logger.error(f"[{index}/{total_docs}] [SKIP] {doc.filename}: file fisik tidak ditemukan di {file_path}")
                 continue
 
-            try:
-                # 2. HAPUS DATA LAMA
-                logger.info("   -> Menghapus vector lama di ChromaDB...")
-                doc_collection.delete(where={"document_id": str(doc_id)})
+            doc_ids.append(doc.id)
+            to_process.append((file_path, doc.filename, doc.id))
 
-                logger.info("   -> Menghapus chunk lama di Database SQL...")
-                num_deleted = DocumentChunk.query.filter_by(document_id=doc_id).delete()
+        missing_count = total_docs - len(to_process)
+        if missing_count:
+            logger.warning(f"{missing_count}/{total_docs} file PDF tidak ditemukan.")
+        if missing_count / total_docs > MAX_MISSING_RATIO and not allow_missing:
+            logger.error(
+                f"File hilang melebihi batas {MAX_MISSING_RATIO:.0%}; re-indexing dibatalkan tanpa menghapus data. "
+                "Periksa UPLOAD_FOLDER/source_path, atau jalankan dengan --allow-missing untuk tetap lanjut.")
+            return
 
-                db.session.delete(doc)
-                db.session.commit()
+        if force:
+            # Hapus penanda lama dulu, agar crash di tengah run --force tetap bisa di-resume
+            for document in PdfDocument.query.filter(reindexed_at.isnot(None)):
+                document.doc_metadata = {k: v for k, v in document.doc_metadata.items() if k != REINDEXED_AT_KEY}
+            db.session.commit()
 
-                logger.info(f"   -> Terhapus {num_deleted} chunks lama.")
+        # Ambil collection
+        try:
+            _, doc_collection = get_collections()
+            logger.info("Berhasil terhubung ke ChromaDB Collection.")
+        except Exception as e:
+            logger.error(f"Gagal koneksi ke ChromaDB: {e}")
+            return
 
-                # 3. PROSES ULANG
-                logger.info("   -> Menjalankan ulang pemrosesan PDF (Sliding Window)...")
-                time.sleep(0.5)
+        # 3. HAPUS DATA LAMA sekaligus untuk semua dokumen (bukan per dokumen)
+        # Dipotong per 'delete_batch' id, agar filter '$in' / IN (...) tidak terlalu besar
+        try:
+            logger.info(f"   -> Menghapus vector lama {len(doc_ids)} dokumen di ChromaDB...")
+            batches = [doc_ids[start:start + delete_batch] for start in range(0, len(doc_ids), delete_batch)]
+            for batch_ids in batches:
+                doc_collection.delete(where={"document_id": {"$in": [str(doc_id) for doc_id in batch_ids]}})
 
-                result = process_and_save_pdf(file_path)
+            # Baris PdfDocument dipertahankan: process_and_save_pdf memakainya lagi (lewat hash),
+            # dan dokumen yang belum selesai tetap ada untuk di-resume jika script terhenti
+            logger.info("   -> Menghapus chunk lama di Database SQL...")
+            num_deleted = 0
+            for batch_ids in batches:
+                num_deleted += DocumentChunk.query.filter(DocumentChunk.document_id.in_(batch_ids)) \
+                    .delete(synchronize_session=False)
+            db.session.commit()
+            # Perbarui statistik planner setelah delete besar, agar query per document_id
+            # selama pemrosesan ulang tetap memakai index (bukan seq scan)
+            db.session.execute(text(f'ANALYZE {DocumentChunk.__tablename__}'))
+            db.session.commit()
+            logger.info(f"   -> Terhapus {num_deleted} chunks lama.")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"   [ERROR] Gagal menghapus data lama: {str(e)}")
+            return
 
-                if result.get("status") == "success":
-                    logger.info(
-                        f"   [SUKSES] Dokumen berhasil di-reindex. Total chunk baru: {result.get('pages_chunked', '?')}")
-                else:
-                    logger.warning(f"   [WARNING] Status: {result.get('status')} - {result.get('reason')}")
+        # 4. PROSES ULANG (paralel antar dokumen, satu proses per worker)
+        workers = workers or _default_worker_count()
+        logger.info(f"Memproses ulang {len(to_process)} dokumen dengan {workers} worker (Sliding Window)...")
 
-            except Exception as e:
-                db.session.rollback()
-                logger.error(f"   [ERROR] Gagal memproses {original_filename}: {str(e)}")
+        def report(original_filename, doc_id, result):
+            if result.get("status") == "success":
+                _mark_reindexed(doc_id, result)
+                logger.info(
+                    f"   [SUKSES] {original_filename} berhasil di-reindex. Total chunk baru: {result.get('pages_chunked', '?')}")
+            else:
+                logger.warning(f"   [WARNING] {original_filename} Status: {result.get('status')} - {result.get('reason')}")
+
+        if workers <= 1:
+            for file_path, original_filename, doc_id in to_process:
+                try:
+                    report(original_filename, doc_id, process_and_save_pdf(file_path))
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"   [ERROR] Gagal memproses {original_filename}: {str(e)}")
+        else:
+            # 'spawn': proses anak membuat app, engine DB, dan client ChromaDB sendiri
+            # (koneksi & thread milik proses induk tidak boleh dipakai bersama setelah fork)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = {pool.submit(_reprocess_file, file_path): (original_filename, doc_id)
+                           for file_path, original_filename, doc_id in to_process}
+                for future in as_completed(futures):
+                    original_filename, doc_id = futures[future]
+                    try:
+                        report(original_filename, doc_id, future.result())
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.error(f"   [ERROR] Gagal memproses {original_filename}: {str(e)}")
 
         logger.info("=== RE-INDEXING SELESAI ===")
 
 
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Hapus embedding lama dan proses ulang (re-index) semua dokumen PDF.")
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help="Lewati konfirmasi (untuk server non-interaktif).")
+    parser.add_argument('--force', action='store_true',
+                        help="Abaikan checkpoint 'reindexed_at' dan reindex ulang semua dokumen.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Jumlah proses worker (default: REINDEX_WORKERS, atau otomatis).")
+    parser.add_argument('--batch-size', type=int, default=DELETE_BATCH,
+                        help=f"Jumlah dokumen per delete ChromaDB/SQL (default: {DELETE_BATCH}).")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="Proses paling banyak N dokumen (untuk uji coba).")
+    parser.add_argument('--allow-missing', action='store_true',
+                        help=f"Tetap lanjut walau lebih dari {MAX_MISSING_RATIO:.0%}% file PDF tidak ditemukan.")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    # --- PERBAIKAN 2: Tambahkan Support Flag '--yes' ---
-    # Cek apakah user menjalankan dengan flag bypass: python reindex_documents.py --yes
-    auto_confirm = len(sys.argv) > 1 and sys.argv[1] in ['--yes', '-y']
+    args = _parse_args()
 
-    if auto_confirm:
+    # Cek apakah user menjalankan dengan flag bypass: python reindex_documents.py --yes
+    if args.yes:
         print("Mode Auto-Confirm aktif. Memulai re-indexing...")
         confirm = 'y'
     else:
@@ -108,6 +252,7 @@ if __name__ == "__main__":
         print("Script ini akan MENGHAPUS embedding lama dan membuat ulang (Re-Index).")
         print("Pastikan file 'app/vector_db.py' sudah benar config Local/Prod-nya.")
         print("Pastikan file PDF asli masih ada di folder uploads.")
+        print("Dokumen yang sudah di-reindex (checkpoint 'reindexed_at') dilewati; pakai --force untuk mengulang semua.")
 
         try:
             confirm = input("\nKetik 'y' untuk lanjut: ")
@@ -119,6 +264,7 @@ if __name__ == "__main__":
             confirm = 'n'
 
     if confirm.lower() == 'y':
-        reindex_all_documents()
+        reindex_all_documents(workers=args.workers, force=args.force, limit=args.limit,
+                              delete_batch=args.batch_size, allow_missing=args.allow_missing)
     else:
-        print("Dibatalkan.")
\ No newline at end of file
+        print("Dibatalkan.")
@@ -1,16 +1,21 @@
+from app import create_app
 from app.models import db, GeminiApiKeyConfig
-from datetime import datetime, timedelta
-import pytz
+from sqlalchemy import update, func, text
 
-# Reset semua key yang quota exceeded lebih dari 24 jam yang lalu
-quota_exceeded_keys = GeminiApiKeyConfig.query.filter_by(quota_exceeded=True).all()
+app = create_app()
 
-for key in quota_exceeded_keys:
-    if key.quota_exceeded_at:
-        reset_time = key.quota_exceeded_at + timedelta(hours=24)
-        if reset_time <= datetime.now(pytz.utc):
-            key.quota_exceeded = False
-            key.quota_exceeded_at = None
-            print(f"Reset quota for key: {key.key_alias}")
+with app.app_context():
+    # Reset semua key yang quota exceeded lebih dari 24 jam yang lalu. Perbandingan waktu
+    # dihitung oleh PostgreSQL (now() - interval), difilter & diubah dengan satu statement UPDATE
+    stmt = (
+        update(GeminiApiKeyConfig)
+        .where(GeminiApiKeyConfig.quota_exceeded == True,
+               GeminiApiKeyConfig.quota_exceeded_at <= func.now() - text("interval '24 hours'"))
+        .values(quota_exceeded=False, quota_exceeded_at=None)
+        .returning(GeminiApiKeyConfig.key_alias)
+    )
+    reset_aliases = db.session.execute(stmt).scalars().all()
+    db.session.commit()
 
-db.session.commit()
\ No newline at end of file
+    for key_alias in reset_aliases:
+        print(f"Reset quota for key: {key_alias}")